@@ -0,0 +1,173 @@
+import threading
+import numpy as np
+import pandas as pd
+from translate_colors import TranslateColors, UnknownCustomAtlasError
+from roi_info import ROIInfo
+
+
+class FrozenDict(dict):
+    """
+    read only dict. lookups behave like dict, any mutation raises TypeError
+    """
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('{} is read only'.format(self.__class__.__name__))
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return self.__class__, (dict(self),)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class AtlasLookup:
+    """
+    AtlasLookup class:
+    numpy lookup arrays of an atlas, so that roi name and rgb index mappings
+    are vectorized take operations rather than per row dict lookups. rois are
+    numbered by dense roi ids, in ascending rgb index order
+       rgb_indices: int64 array, roi id -> rgb index
+       roi_names: object array, roi id -> roi name
+       roi_name_dtype: pandas CategoricalDtype of roi_names, its categorical codes are roi ids
+       gray_matter: bool array, roi id -> roi is gray matter
+    rgb atlas images are mapped to roi ids through color_lut, a uint16 table
+    over all 2 ** 24 packed colors, built on first use
+    roi_info: ROIInfo of the atlas. index2roi is expected to be one to one
+    """
+    UNKNOWN_ID = np.iinfo(np.uint16).max
+    N_COLORS = 1 << 24
+    TILE_ROWS = 256
+
+    def __init__(self, roi_info):
+        rgb_indices = sorted(roi_info.index2roi)
+        self.rgb_indices = np.array(rgb_indices, dtype=np.int64)
+        self.roi_names = np.array([roi_info.index2roi[rgb_index] for rgb_index in rgb_indices], dtype=object)
+        if len(set(self.roi_names)) != len(self.roi_names):
+            raise ValueError('roi names of atlas {} are not unique'.format(roi_info.rgb_codec.associated_atlas))
+        self.roi_name_dtype = pd.CategoricalDtype(self.roi_names)
+        self.gray_matter = np.isin(self.rgb_indices, list(roi_info.gray_matter_indices))
+        for lookup_array in [self.rgb_indices, self.roi_names, self.gray_matter]:
+            lookup_array.setflags(write=False)
+        if len(self.rgb_indices) >= AtlasLookup.UNKNOWN_ID:
+            raise ValueError('atlas {} has too many rois for uint16 roi ids'
+                             .format(roi_info.rgb_codec.associated_atlas))
+        self._color_lut = None
+
+    def roi_ids(self, roi_names):
+        """ :return: int64 array of the roi ids of roi_names, -1 for unknown roi names """
+        return pd.Categorical(np.asarray(roi_names, dtype=object), dtype=self.roi_name_dtype).codes.astype(np.int64)
+
+    def roi_ids_by_rgb_index(self, rgb_indices):
+        """ :return: int64 array of the roi ids of rgb_indices, -1 for unknown rgb indices """
+        rgb_indices = np.asarray(rgb_indices, dtype=np.int64)
+        roi_ids = np.minimum(np.searchsorted(self.rgb_indices, rgb_indices), len(self.rgb_indices) - 1)
+        return np.where(self.rgb_indices[roi_ids] == rgb_indices, roi_ids, -1)
+
+    @staticmethod
+    def _assert_known(roi_ids, keys):
+        if (roi_ids < 0).any():
+            raise KeyError('unknown rois {}'.format(sorted(set(np.asarray(keys)[roi_ids < 0].tolist()))))
+
+    def rgb_index_of(self, roi_names):
+        """ vectorized roi_info.roi2index[roi_name]. raises KeyError for unknown roi names """
+        roi_ids = self.roi_ids(roi_names)
+        AtlasLookup._assert_known(roi_ids, roi_names)
+        return self.rgb_indices.take(roi_ids)
+
+    def roi_name_of(self, rgb_indices):
+        """ vectorized rgb_codec.index_to_region(rgb_index). raises KeyError for unknown rgb indices """
+        roi_ids = self.roi_ids_by_rgb_index(rgb_indices)
+        AtlasLookup._assert_known(roi_ids, rgb_indices)
+        return self.roi_names.take(roi_ids)
+
+    def is_gray_matter(self, rgb_indices):
+        """ :return: bool array, whether each of rgb_indices is a known gray matter roi """
+        roi_ids = self.roi_ids_by_rgb_index(rgb_indices)
+        return (roi_ids >= 0) & self.gray_matter.take(roi_ids)
+
+    @property
+    def color_lut(self):
+        """ read only uint16 array, packed rgb index -> roi id, UNKNOWN_ID for colors that are not rois """
+        if self._color_lut is None:
+            color_lut = np.full(AtlasLookup.N_COLORS, AtlasLookup.UNKNOWN_ID, dtype=np.uint16)
+            color_lut[self.rgb_indices] = np.arange(len(self.rgb_indices), dtype=np.uint16)
+            color_lut.setflags(write=False)
+            self._color_lut = color_lut
+        return self._color_lut
+
+    def rgbatlas_to_roi_ids(self, rgb_atlas, out=None, tile_rows=TILE_ROWS):
+        """
+        roi id of each pixel of a bgr atlas image, as read by cv2.imread
+        the image is converted tile_rows rows at a time, so rgb_atlas and out
+        may be memory mapped arrays larger than memory
+        :param out: uint16 array (row, col) the roi ids are written to, allocated if None
+        :return: out
+        """
+        assert len(rgb_atlas.shape) == 3, "rgb_atlas must have r, g, b channels"
+        if out is None:
+            out = np.empty(rgb_atlas.shape[:2], dtype=np.uint16)
+        elif out.shape != rgb_atlas.shape[:2] or out.dtype != np.uint16:
+            raise ValueError('out should be a uint16 array of shape {}'.format(rgb_atlas.shape[:2]))
+        color_lut = self.color_lut
+        for start in range(0, rgb_atlas.shape[0], tile_rows):
+            stop = min(start + tile_rows, rgb_atlas.shape[0])
+            index_tile = TranslateColors.rgbatlas_to_indexatlas(rgb_atlas[start: stop])
+            np.take(color_lut, index_tile, out=out[start: stop])
+        return out
+
+
+class AtlasRegistry:
+    """
+    AtlasRegistry class:
+    process wide registry of TranslateColors, ROIInfo and AtlasLookup
+    instances, one of each per custom atlas. they are built on first request
+    and shared by all later requests. the lookup tables of registered instances are frozen:
+    rgb_codec.LOOKUP, rgb_codec.REV_LOOKUP, roi_info.index2roi and
+    roi_info.roi2index are FrozenDict, roi_info.gray_matter_indices is a
+    frozenset. callers that need to modify the tables should construct their
+    own TranslateColors and ROIInfo instances instead
+    """
+    _rgb_codecs = {}
+    _roi_infos = {}
+    _lookups = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def _register(cls, custom_atlas):
+        with cls._lock:
+            if custom_atlas in cls._roi_infos:
+                return
+            if custom_atlas not in TranslateColors.CUSTOM_ATLAS_LOOKUP:
+                raise UnknownCustomAtlasError(custom_atlas)
+            rgb_codec = TranslateColors(custom_atlas=custom_atlas)
+            roi_info = ROIInfo(rgb_codec)
+            rgb_codec.LOOKUP = FrozenDict(rgb_codec.LOOKUP)
+            rgb_codec.REV_LOOKUP = FrozenDict(rgb_codec.REV_LOOKUP)
+            roi_info.index2roi = FrozenDict(roi_info.index2roi)
+            roi_info.roi2index = FrozenDict(roi_info.roi2index)
+            roi_info.gray_matter_indices = frozenset(roi_info.gray_matter_indices)
+            cls._rgb_codecs[custom_atlas] = rgb_codec
+            cls._lookups[custom_atlas] = AtlasLookup(roi_info)
+            cls._roi_infos[custom_atlas] = roi_info
+
+    @classmethod
+    def rgb_codec(cls, custom_atlas=TranslateColors.DEFAULT_ASSOCIATED_ATLAS):
+        if custom_atlas not in cls._rgb_codecs:
+            cls._register(custom_atlas)
+        return cls._rgb_codecs[custom_atlas]
+
+    @classmethod
+    def roi_info(cls, custom_atlas=TranslateColors.DEFAULT_ASSOCIATED_ATLAS):
+        if custom_atlas not in cls._roi_infos:
+            cls._register(custom_atlas)
+        return cls._roi_infos[custom_atlas]
+
+    @classmethod
+    def lookup(cls, custom_atlas=TranslateColors.DEFAULT_ASSOCIATED_ATLAS):
+        if custom_atlas not in cls._roi_infos:
+            cls._register(custom_atlas)
+        return cls._lookups[custom_atlas]
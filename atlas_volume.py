@@ -0,0 +1,138 @@
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import cv2
+from atlas_registry import AtlasRegistry, AtlasLookup
+from custom_atlas_config import CustomAtlasConfig, AtlasLevelScan
+
+
+# convert the rgb atlas image at atlas_path to roi ids and write it to row of the
+# label volume at volume_path. module level so that it can be sent to worker processes
+def _write_level(volume_path, row, atlas_path, custom_atlas):
+    rgb_atlas = cv2.imread(atlas_path, -1)
+    if rgb_atlas is None:
+        raise ValueError('cannot read atlas image {}'.format(atlas_path))
+    labels = np.load(volume_path, mmap_mode='r+')
+    if labels.shape[1:] != rgb_atlas.shape[:2]:
+        raise ValueError('atlas image {} is {}, other levels are {}'
+                         .format(atlas_path, rgb_atlas.shape[:2], labels.shape[1:]))
+    AtlasRegistry.lookup(custom_atlas).rgbatlas_to_roi_ids(rgb_atlas, out=labels[row])
+    labels.flush()
+
+
+class AtlasVolume:
+    """
+    AtlasVolume class:
+    label volume of a custom atlas, memory mapped read only
+       labels: uint16 array (level, row, col), roi id of each pixel, UNKNOWN_ID
+       for colors that are not rois of the atlas
+       rgb_indices: int64 array, roi id -> rgb index
+       levels: int64 array, the atlas level of each plane of labels
+    roi ids are the ids of the atlas's AtlasLookup at the time the volume was
+    built, see AtlasVolumeStore.build
+    """
+    UNKNOWN_ID = AtlasLookup.UNKNOWN_ID
+    LABELS_NAME = 'labels.npy'
+    RGB_INDICES_NAME = 'rgb_indices.npy'
+    LEVELS_NAME = 'levels.npy'
+
+    def __init__(self, volume_dir):
+        self.volume_dir = volume_dir
+        self.labels = np.load(os.path.join(volume_dir, AtlasVolume.LABELS_NAME), mmap_mode='r')
+        self.rgb_indices = np.load(os.path.join(volume_dir, AtlasVolume.RGB_INDICES_NAME))
+        self.levels = np.load(os.path.join(volume_dir, AtlasVolume.LEVELS_NAME))
+
+    def _row(self, level):
+        rows = np.flatnonzero(self.levels == level)
+        if len(rows) == 0:
+            raise ValueError('level {} is not in the atlas volume'.format(level))
+        return rows[0]
+
+    def level_labels(self, level):
+        """
+        :return: uint16 array (row, col), read only view of the roi ids at level
+        """
+        return self.labels[self._row(level)]
+
+    def level_index_atlas(self, level):
+        """
+        :return: int64 array (row, col), rgb index of each pixel at level as
+                 TranslateColors.rgbatlas_to_indexatlas, -1 for unknown colors
+        """
+        labels = self.level_labels(level)
+        return np.where(labels == AtlasVolume.UNKNOWN_ID, -1,
+                        self.rgb_indices.take(np.minimum(labels, len(self.rgb_indices) - 1)))
+
+
+class AtlasVolumeStore:
+    """
+    AtlasVolumeStore class:
+    one time conversion of the rgb atlas images of a custom atlas into an
+    AtlasVolume, saved as .npy files under store_dir in a directory per atlas
+    and atlas version. later reads are memory mapped slices rather than image
+    decodes. all levels are expected to have the same image size
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+    def volume_dir(self, custom_atlas):
+        version = CustomAtlasConfig.atlas_version(custom_atlas)
+        return os.path.join(self.store_dir, '{}_{}'.format(custom_atlas, version))
+
+    def is_built(self, custom_atlas):
+        return os.path.isfile(os.path.join(self.volume_dir(custom_atlas), AtlasVolume.LABELS_NAME))
+
+    def build(self, custom_atlas, root_dir=None, n_workers=None):
+        """
+        convert every level of custom_atlas, replacing any existing volume
+        :param root_dir: see CustomAtlasConfig.gen_atlas_path
+        :param n_workers: if None or 1, levels are converted in process,
+                          otherwise in a pool of n_workers processes
+        :return: AtlasVolume
+        """
+        rgb_indices = AtlasRegistry.lookup(custom_atlas).rgb_indices
+        levels = np.arange(1, AtlasLevelScan.N_LEVELS + 1)
+        atlas_paths = [CustomAtlasConfig.gen_atlas_path(int(level), custom_atlas, root_dir=root_dir)[1]
+                       for level in levels]
+        first_atlas = cv2.imread(atlas_paths[0], -1)
+        if first_atlas is None:
+            raise ValueError('cannot read atlas image {}'.format(atlas_paths[0]))
+        if not os.path.isdir(self.store_dir):
+            os.makedirs(self.store_dir)
+        # built in a temporary directory that replaces the volume directory when complete
+        build_dir = tempfile.mkdtemp(dir=self.store_dir)
+        try:
+            volume_path = os.path.join(build_dir, AtlasVolume.LABELS_NAME)
+            labels = np.lib.format.open_memmap(volume_path, mode='w+', dtype=np.uint16,
+                                               shape=(len(levels),) + first_atlas.shape[:2])
+            del labels
+            args = [(volume_path, row, atlas_path, custom_atlas) for row, atlas_path in enumerate(atlas_paths)]
+            if n_workers is None or n_workers <= 1:
+                for level_args in args:
+                    _write_level(*level_args)
+            else:
+                with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                    futures = [executor.submit(_write_level, *level_args) for level_args in args]
+                    for future in futures:
+                        future.result()
+            np.save(os.path.join(build_dir, AtlasVolume.RGB_INDICES_NAME), np.asarray(rgb_indices))
+            np.save(os.path.join(build_dir, AtlasVolume.LEVELS_NAME), levels)
+            volume_dir = self.volume_dir(custom_atlas)
+            if os.path.isdir(volume_dir):
+                shutil.rmtree(volume_dir)
+            os.rename(build_dir, volume_dir)
+        except BaseException:
+            shutil.rmtree(build_dir, ignore_errors=True)
+            raise
+        return AtlasVolume(volume_dir)
+
+    def open(self, custom_atlas, root_dir=None, n_workers=None):
+        """
+        :return: AtlasVolume of custom_atlas, built first if the store does not hold it
+        """
+        if not self.is_built(custom_atlas):
+            return self.build(custom_atlas, root_dir=root_dir, n_workers=n_workers)
+        return AtlasVolume(self.volume_dir(custom_atlas))
@@ -0,0 +1,119 @@
+from __future__ import division
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy.cluster.hierarchy import fcluster
+from pair_distance import PairDistance
+
+StabilityResult = namedtuple('StabilityResult', ['linkage', 'labels', 'co_clustering', 'node_support'])
+
+
+# leaf sets of the clusters formed by each merge of linkage z, as int bit masks.
+# leaf i of z is bit leaves[i], bit i by default
+def _clade_masks(z, leaves=None):
+    n = len(z) + 1
+    masks = [1 << int(leaf) for leaf in (range(n) if leaves is None else leaves)]
+    for a, b in z[:, :2].astype(np.int64):
+        masks.append(masks[a] | masks[b])
+    return masks[n:]
+
+
+# cluster the resamples drawn from seeds. module level so that it can be sent to
+# worker processes. returns summed counts, see ClusterStability.run
+def _resample_counts(x, distance_type, n_clusters, clades, seeds, bootstrap_features, n_items):
+    n = x.shape[0]
+    co_clustered = np.zeros((n, n), dtype=np.int64)
+    co_sampled = np.zeros((n, n), dtype=np.int64)
+    supported = np.zeros(len(clades), dtype=np.int64)
+    tested = np.zeros(len(clades), dtype=np.int64)
+    for seed in seeds:
+        rng = np.random.default_rng(seed)
+        items = np.arange(n) if n_items == n else np.sort(rng.choice(n, size=n_items, replace=False))
+        features = np.arange(x.shape[1])
+        if bootstrap_features:
+            features = rng.integers(0, x.shape[1], size=x.shape[1])
+        z = PairDistance.complete_linkage(x[np.ix_(items, features)], distance_type)
+        labels = fcluster(z, n_clusters, criterion='maxclust')
+        co_clustered[np.ix_(items, items)] += labels[:, np.newaxis] == labels[np.newaxis, :]
+        co_sampled[np.ix_(items, items)] += 1
+        # clades of the reference tree are restricted to the sampled items.
+        # single items and the whole sample are clades of any tree, and not tested
+        resampled_clades = _clade_masks(z, leaves=items)
+        sampled = resampled_clades[-1]
+        resampled_clades = set(resampled_clades)
+        for clade_id, clade in enumerate(clades):
+            restricted = clade & sampled
+            if restricted == sampled or bin(restricted).count('1') < 2:
+                continue
+            tested[clade_id] += 1
+            supported[clade_id] += restricted in resampled_clades
+    return co_clustered, co_sampled, supported, tested
+
+
+class ClusterStability:
+    """
+    ClusterStability class:
+    stability of the complete linkage clustering of the rows of a matrix, as
+    clustered by TracerAnalysis.cluster_2d (see PairDistance.complete_linkage),
+    estimated by clustering resampled matrices. each resample
+       bootstraps the columns (the features the rows are compared by) if
+       bootstrap_features is True, and
+       draws item_fraction of the rows without replacement, if item_fraction is
+       less than 1
+    results:
+       co_clustering: data frame (row, row), fraction of the resamples holding
+       both rows in which both fall in the same of n_clusters clusters
+       node_support: float array aligned to the rows of the reference linkage,
+       fraction of the resamples in which the leaves of the node form a node of
+       the resampled tree. nan if no resample could test the node
+    resample i draws from the random generator seeded with the i-th child of
+    np.random.SeedSequence(seed), so results do not depend on n_workers. no
+    figures are rendered
+    n_workers: if None or 1, resamples are clustered in process, otherwise in a
+    pool of n_workers processes
+    """
+    def __init__(self, df, distance_type='cosine', n_clusters=2, n_resamples=100, seed=0, bootstrap_features=True,
+                 item_fraction=1., n_workers=None):
+        if distance_type not in PairDistance.DISTANCE_TYPES:
+            raise ValueError('distance_type {} not understood'.format(distance_type))
+        if not 0 < item_fraction <= 1:
+            raise ValueError('item_fraction should be in (0, 1]')
+        self.df = df
+        self.distance_type = distance_type
+        self.n_clusters = n_clusters
+        self.n_resamples = n_resamples
+        self.seed = seed
+        self.bootstrap_features = bootstrap_features
+        self.item_fraction = item_fraction
+        self.n_workers = n_workers
+
+    def run(self):
+        """
+        :return: StabilityResult of the reference linkage and cluster labels of
+                 self.df, the co-clustering matrix and the node supports
+        """
+        x = np.asarray(self.df.values, dtype=np.float64)
+        n = x.shape[0]
+        n_items = max(2, int(round(self.item_fraction * n)))
+        if n < 2 or n_items > n:
+            raise ValueError('at least 2 rows are needed to cluster')
+        z = PairDistance.complete_linkage(x, self.distance_type)
+        labels = fcluster(z, self.n_clusters, criterion='maxclust')
+        clades = _clade_masks(z)
+        seeds = np.random.SeedSequence(self.seed).spawn(self.n_resamples)
+        args = (x, self.distance_type, self.n_clusters, clades)
+        if self.n_workers is None or self.n_workers <= 1:
+            counts = [_resample_counts(*args, seeds, self.bootstrap_features, n_items)]
+        else:
+            batches = np.array_split(np.arange(self.n_resamples), min(self.n_resamples, 4 * self.n_workers))
+            with ProcessPoolExecutor(max_workers=self.n_workers) as executor:
+                futures = [executor.submit(_resample_counts, *args, [seeds[i] for i in batch],
+                                           self.bootstrap_features, n_items) for batch in batches if len(batch) > 0]
+                counts = [future.result() for future in futures]
+        co_clustered, co_sampled, supported, tested = [sum(batch_counts) for batch_counts in zip(*counts)]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            co_clustering = co_clustered / co_sampled
+            node_support = supported / tested
+        co_clustering = pd.DataFrame(co_clustering, index=self.df.index, columns=self.df.index)
+        return StabilityResult(z, labels, co_clustering, node_support)
@@ -0,0 +1,274 @@
+from __future__ import division
+from collections.abc import MutableMapping
+import numpy as np
+import pandas as pd
+
+
+class ConnectivityCube:
+    """
+    ConnectivityCube class:
+    count, area and fraction of a set of rows stored as contiguous float arrays
+    of shape (row, roi, hemisphere). a row is a case tracer, or a group of case
+    tracers after case aggregation. density is derived from fraction and area
+    on request, normalized by max_density
+    axes:
+       row_labels: dict 'injection_site': array, and 'case_tracer': array unless
+       rows were aggregated by injection site
+       roi_names: roi names without hemisphere suffix
+       hemispheres: hemisphere suffixes, in the order of ConnectivityCube.HEMISPHERES
+    integer index maps:
+       injection_sites, injection_site_codes: unique injection sites, and the
+       position of each row's injection site in injection_sites
+       case_tracers, case_tracer_codes: same for case tracers, None if rows are
+       not labeled by case tracer
+       roi_ids: dict roi name: position on the roi axis
+    fraction is carried through roi selection and aggregation rather than
+    recomputed, as it is normalized against the total count of a row over all rois
+    max_density is the max of fraction / area over all rows. rows can be
+    appended or dropped without recomputing the fraction of the other rows, in
+    which case max_density is kept as a running max, and only recomputed when
+    the dropped rows held it
+    count, area and fraction are read only, and may be views of the arrays of
+    the cube they were selected from.
+    data frames are only built by frame(). their columns are hemisphere roi
+    names '{roi}_{hemisphere}', roi major and hemisphere minor, or sorted by name
+    if sort_columns is True
+    """
+    # hemisphere axis. c is contralateral, i is ipsilateral
+    HEMISPHERES = ['c', 'i']
+    DATA_TYPES = ['count', 'area', 'fraction', 'density']
+    ROW_LEVELS = ['injection_site', 'case_tracer']
+    # added to area when dividing fraction by area
+    AREA_EPSILON = 1e-9
+
+    def __init__(self, count, area, row_labels, roi_names, hemispheres=None, fraction=None, max_density=None,
+                 sort_columns=False):
+        # arrays may be views of another cube's arrays
+        self.count = np.asarray(count, dtype=np.float64)
+        self.area = np.asarray(area, dtype=np.float64)
+        if self.count.ndim != 3 or self.count.shape != self.area.shape:
+            raise ValueError('count and area should have identical (row, roi, hemisphere) shapes')
+        self.row_labels = {level: np.asarray(row_labels[level], dtype=object)
+                           for level in ConnectivityCube.ROW_LEVELS if level in row_labels}
+        self.roi_names = np.asarray(roi_names, dtype=object)
+        self.hemispheres = list(ConnectivityCube.HEMISPHERES) if hemispheres is None else list(hemispheres)
+        if len(self.row_labels['injection_site']) != self.count.shape[0] or \
+           len(self.roi_names) != self.count.shape[1] or len(self.hemispheres) != self.count.shape[2]:
+            raise ValueError('axis labels do not match data shape {}'.format(self.count.shape))
+        # divide count by row sum
+        if fraction is None:
+            fraction = self.count / self.count.sum(axis=(1, 2))[:, np.newaxis, np.newaxis]
+        self.fraction = np.asarray(fraction, dtype=np.float64)
+        if max_density is None:
+            max_density = np.max(self.fraction / (self.area + ConnectivityCube.AREA_EPSILON))
+        self.max_density = max_density
+        self.sort_columns = sort_columns
+        # cubes are shared, e.g. between cached selections. operations return new cubes
+        for values in [self.count, self.area, self.fraction]:
+            values.setflags(write=False)
+
+        self.injection_sites, self.injection_site_codes = np.unique(self.row_labels['injection_site'],
+                                                                    return_inverse=True)
+        self.case_tracers = self.case_tracer_codes = None
+        if 'case_tracer' in self.row_labels:
+            self.case_tracers, self.case_tracer_codes = np.unique(self.row_labels['case_tracer'], return_inverse=True)
+        self.roi_ids = {roi_name: roi_id for roi_id, roi_name in enumerate(self.roi_names)}
+
+    @classmethod
+    def from_tracer_connectivities(cls, tracer_connectivities):
+        """
+        one row per TracerConnectivity instance, summed over the ara levels in
+        its ara_level_subset. all instances should share the same rois
+        """
+        tracer_connectivity0 = tracer_connectivities[0]
+        for tracer_connectivity in tracer_connectivities[1:]:
+            if not np.array_equal(tracer_connectivity.roi_indices, tracer_connectivity0.roi_indices):
+                raise ValueError('inconsistent rois between {} channel {} and {} channel {}'
+                                 .format(tracer_connectivity0.case_name, tracer_connectivity0.channel_number,
+                                         tracer_connectivity.case_name, tracer_connectivity.channel_number))
+        # (row, roi, hemisphere, value). TracerConnectivity hemisphere l is contralateral, r is ipsilateral
+        tensor = np.stack([tracer_connectivity.reduce_level_tensor()
+                           for tracer_connectivity in tracer_connectivities])
+        values = tracer_connectivity0.LEVEL_TENSOR_VALUES
+        row_labels = {
+            'injection_site': [tracer_connectivity.injection_site for tracer_connectivity in tracer_connectivities],
+            'case_tracer': [tracer_connectivity.case_tracer() for tracer_connectivity in tracer_connectivities]
+        }
+        return cls(tensor[..., values.index('overlap')], tensor[..., values.index('area')], row_labels,
+                   tracer_connectivity0.roi_names)
+
+    def _derive(self, count, area, fraction, row_labels=None, roi_names=None, hemispheres=None, sort_columns=None):
+        return ConnectivityCube(count, area, self.row_labels if row_labels is None else row_labels,
+                                self.roi_names if roi_names is None else roi_names,
+                                hemispheres=self.hemispheres if hemispheres is None else hemispheres,
+                                fraction=fraction, max_density=self.max_density,
+                                sort_columns=self.sort_columns if sort_columns is None else sort_columns)
+
+    def density(self):
+        return self.fraction / (self.area + ConnectivityCube.AREA_EPSILON) / self.max_density
+
+    # max of fraction / area of each row, before normalization by max_density
+    def row_max_density(self):
+        return np.max(self.fraction / (self.area + ConnectivityCube.AREA_EPSILON), axis=(1, 2), initial=-np.inf)
+
+    def values(self, data_type):
+        if data_type == 'density':
+            return self.density()
+        if data_type not in ConnectivityCube.DATA_TYPES:
+            raise ValueError('data type {} not understood'.format(data_type))
+        return getattr(self, data_type)
+
+    ############################################################################
+    #                           index and reductions                           #
+    ############################################################################
+    def take_rows(self, row_ids):
+        row_labels = {level: labels[row_ids] for level, labels in self.row_labels.items()}
+        return self._derive(self.count[row_ids], self.area[row_ids], self.fraction[row_ids], row_labels=row_labels)
+
+    def append_rows(self, other):
+        """
+        rows of self followed by the rows of other, a cube with the same rois,
+        hemispheres and row levels. fractions of both are kept as they are, and
+        max_density is the max of both max densities
+        """
+        if not np.array_equal(self.roi_names, other.roi_names) or self.hemispheres != other.hemispheres or \
+           set(self.row_labels) != set(other.row_labels):
+            raise ValueError('cubes with different rois, hemispheres or row levels can not be appended')
+        row_labels = {level: np.concatenate([labels, other.row_labels[level]])
+                      for level, labels in self.row_labels.items()}
+        return ConnectivityCube(np.concatenate([self.count, other.count]), np.concatenate([self.area, other.area]),
+                                row_labels, self.roi_names, hemispheres=self.hemispheres,
+                                fraction=np.concatenate([self.fraction, other.fraction]),
+                                max_density=max(self.max_density, other.max_density), sort_columns=self.sort_columns)
+
+    def drop_rows(self, row_mask):
+        """
+        rows of self not in row_mask. max_density is recomputed over the
+        remaining rows only if a dropped row held it
+        :param row_mask: bool array, True for the rows to drop
+        """
+        row_mask = np.asarray(row_mask, dtype=bool)
+        kept = self.take_rows(np.flatnonzero(~row_mask))
+        if row_mask.any() and self.row_max_density()[row_mask].max() >= self.max_density:
+            kept.max_density = np.max(kept.row_max_density())
+        return kept
+
+    def group_rows(self, codes, row_labels):
+        """
+        sum count and area of rows sharing a code. fraction is renormalized
+        against the row sums of the groups
+        :param codes: int array, group of each row in range(n_groups)
+        :param row_labels: dict level: labels of the groups
+        """
+        n_groups = len(row_labels['injection_site'])
+        count = np.zeros((n_groups,) + self.count.shape[1:])
+        area = np.zeros((n_groups,) + self.area.shape[1:])
+        np.add.at(count, codes, self.count)
+        np.add.at(area, codes, self.area)
+        return self._derive(count, area, None, row_labels=row_labels)
+
+    def take_rois(self, roi_ids):
+        roi_ids = np.asarray(roi_ids, dtype=np.int64)
+        return self._derive(self.count[:, roi_ids], self.area[:, roi_ids], self.fraction[:, roi_ids],
+                            roi_names=self.roi_names[roi_ids], sort_columns=True)
+
+    def aggregate_rois(self, matrix, roi_names):
+        """
+        count, area and fraction of coarse rois, summed from the rois of the
+        cube by a single sparse matmul
+        :param matrix: sparse matrix of shape (roi, coarse roi), see RoiAggregation
+        :param roi_names: names of the coarse rois
+        """
+        n_rows, n_rois, n_hemispheres = self.count.shape
+        # (data type, row, roi, hemisphere) -> (roi, data type * row * hemisphere)
+        stacked = np.stack([self.count, self.area, self.fraction]).transpose(2, 0, 1, 3).reshape(n_rois, -1)
+        aggregated = np.asarray(matrix.T.dot(stacked))
+        count, area, fraction = aggregated.reshape(len(roi_names), 3, n_rows, n_hemispheres).transpose(1, 2, 0, 3)
+        return self._derive(count, area, fraction, roi_names=roi_names, sort_columns=True)
+
+    def take_hemispheres(self, hemispheres):
+        hemisphere_ids = [self.hemispheres.index(hemisphere) for hemisphere in hemispheres]
+        # a run of consecutive hemispheres is selected as a view
+        if hemisphere_ids == list(range(hemisphere_ids[0], hemisphere_ids[-1] + 1)):
+            hemisphere_ids = slice(hemisphere_ids[0], hemisphere_ids[-1] + 1)
+        return self._derive(self.count[:, :, hemisphere_ids], self.area[:, :, hemisphere_ids],
+                            self.fraction[:, :, hemisphere_ids], hemispheres=hemispheres)
+
+    ############################################################################
+    #                              materialization                             #
+    ############################################################################
+    def row_index(self):
+        if 'case_tracer' in self.row_labels:
+            return pd.MultiIndex.from_arrays([self.row_labels['injection_site'], self.row_labels['case_tracer']],
+                                             names=['injection_site', 'case_tracer'])
+        return pd.Index(self.row_labels['injection_site'], name='injection_site')
+
+    # position of each data frame column on the flattened (roi, hemisphere) axes, and its name
+    def _columns(self):
+        column_names = np.array(['{}_{}'.format(roi_name, hemisphere)
+                                 for roi_name in self.roi_names for hemisphere in self.hemispheres], dtype=object)
+        column_ids = np.arange(len(column_names))
+        if self.sort_columns:
+            column_ids = np.argsort(column_names, kind='stable')
+        return column_ids, column_names[column_ids]
+
+    def frame(self, data_type, copy=False):
+        """
+        data frame of data_type. unless columns are sorted, count, area and
+        fraction data frames are read only views of the cube's arrays
+        :param copy: if True, read only values are copied, so that the data
+                     frame is always writable and never shares the cube's memory
+        """
+        column_ids, column_names = self._columns()
+        values = self.values(data_type).reshape(self.count.shape[0], -1)
+        if self.sort_columns:
+            values = values[:, column_ids]
+        if copy and not values.flags.writeable:
+            values = values.copy()
+        return pd.DataFrame(values, index=self.row_index(), columns=pd.Index(column_names, name='roi_name'),
+                            copy=False)
+
+
+class CubeFrames(MutableMapping):
+    """
+    dict like view of a ConnectivityCube with keys 'count', 'area',
+    'fraction' and 'density'. the data frame of a key is built from the
+    cube on first access and kept. it owns its values, whatever the
+    selection the cube holds, so it can be modified in place without
+    modifying the cube. the copy is only made for keys that are accessed.
+    assigning a new data frame to a key replaces the built data frame, without
+    modifying the cube. empty if cube is None
+    """
+    def __init__(self, cube=None):
+        self.cube = cube
+        self._keys = list(ConnectivityCube.DATA_TYPES) if cube is not None else []
+        self._frames = {}
+
+    def __getitem__(self, data_type):
+        if data_type not in self._keys:
+            raise KeyError(data_type)
+        if data_type not in self._frames:
+            self._frames[data_type] = self.cube.frame(data_type, copy=True)
+        return self._frames[data_type]
+
+    def __setitem__(self, data_type, df):
+        if data_type not in self._keys:
+            self._keys.append(data_type)
+        self._frames[data_type] = df
+
+    def __delitem__(self, data_type):
+        if data_type not in self._keys:
+            raise KeyError(data_type)
+        self._keys.remove(data_type)
+        self._frames.pop(data_type, None)
+
+    def __iter__(self):
+        return iter(list(self._keys))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def clear(self):
+        self.cube = None
+        self._keys = []
+        self._frames.clear()
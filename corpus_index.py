@@ -0,0 +1,129 @@
+from __future__ import print_function
+import os
+import json
+import tempfile
+from csv_parser import MetaCsvParser
+
+
+class CorpusIndex:
+    """
+    CorpusIndex class:
+    persistent index of the meta info of overlap csv files (project, case,
+    slide, channel, ara level, tracer, injection site, atlas, connection lens
+    version, ...), read from the metalines alone. csv files can then be
+    selected, e.g. by tracer direction, before any data block is parsed
+    the index is a single json file under index_dir, mapping the absolute path
+    of each csv file to its meta info and the key it was read with:
+        (file size, mtime in ns)
+    a record is only used if its key matches the csv file on disk, otherwise
+    the metalines are read again. the index is written by save()
+    """
+    # bump when the record format changes
+    INDEX_VERSION = 1
+    INDEX_NAME = 'corpus_index.json'
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        if not os.path.isdir(self.index_dir):
+            os.makedirs(self.index_dir)
+        self.records = self._read_index()
+        # records added or replaced since the index was read or saved
+        self._modified = False
+
+    @staticmethod
+    def csv_key(csv_path):
+        stat = os.stat(csv_path)
+        return {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns
+        }
+
+    def index_path(self):
+        return os.path.join(self.index_dir, CorpusIndex.INDEX_NAME)
+
+    def _read_index(self):
+        index_path = self.index_path()
+        if not os.path.isfile(index_path):
+            return {}
+        try:
+            with open(index_path, 'r') as f:
+                index = json.load(f)
+        except (IOError, OSError, ValueError):
+            # unreadable or partially written index, start over
+            return {}
+        if index.get('version') != CorpusIndex.INDEX_VERSION:
+            return {}
+        return index['records']
+
+    def meta_parser(self, csv_path):
+        """
+        :return: MetaCsvParser of csv_path. its metalines are only read if the
+                 index has no up to date record of the file
+        """
+        csv_path = os.path.abspath(csv_path)
+        key = CorpusIndex.csv_key(csv_path)
+        record = self.records.get(csv_path)
+        if record is not None and record['key'] == key:
+            return MetaCsvParser(csv_path, meta_info=record['meta_info'])
+        csv_parser = MetaCsvParser(csv_path)
+        self.records[csv_path] = {
+            'key': key,
+            'meta_info': csv_parser.meta_info()
+        }
+        self._modified = True
+        return csv_parser
+
+    def update(self, overlap_dirs):
+        """
+        bring the records of all csv files in overlap_dirs up to date, drop the
+        records of csv files removed from overlap_dirs and save the index
+        """
+        for overlap_dir in overlap_dirs:
+            if not os.path.isdir(overlap_dir):
+                raise ValueError('{} is not a directory'.format(overlap_dir))
+            overlap_dir = os.path.abspath(overlap_dir)
+            csv_paths = set(os.path.join(overlap_dir, name) for name in os.listdir(overlap_dir) if name.endswith('.csv'))
+            for csv_path in self.records.keys() - csv_paths:
+                if os.path.dirname(csv_path) == overlap_dir:
+                    del self.records[csv_path]
+                    self._modified = True
+            for csv_path in sorted(csv_paths):
+                self.meta_parser(csv_path)
+        self.save()
+
+    def select(self, overlap_dirs, predicate):
+        """
+        :param predicate: callable on a MetaCsvParser, e.g. lambda p: p.is_anterograde()
+        :return: list of paths of the csv files in overlap_dirs the predicate is true for
+        """
+        self.update(overlap_dirs)
+        overlap_dirs = set(os.path.abspath(overlap_dir) for overlap_dir in overlap_dirs)
+        return [csv_path for csv_path in sorted(self.records)
+                if os.path.dirname(csv_path) in overlap_dirs and predicate(self.meta_parser(csv_path))]
+
+    def csv_filter(self, predicate):
+        """
+        :param predicate: callable on a MetaCsvParser, e.g. lambda p: p.is_anterograde()
+        :return: callable (overlap_dir, csv_name) -> bool, the csv_filter of TracerConnectivityBuilder
+        """
+        return lambda overlap_dir, csv_name: predicate(self.meta_parser(os.path.join(overlap_dir, csv_name)))
+
+    def save(self):
+        if not self._modified:
+            return
+        index = {
+            'version': CorpusIndex.INDEX_VERSION,
+            'records': self.records
+        }
+        # write to a temporary file then rename, so that concurrent readers
+        # never see a partially written index
+        fd, tmp_path = tempfile.mkstemp(dir=self.index_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(index, f)
+            os.replace(tmp_path, self.index_path())
+        except BaseException:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._modified = False
@@ -1,25 +1,34 @@
 from __future__ import print_function
 import os
+import itertools
 from abc import ABCMeta, abstractmethod
 import warnings
+import numpy as np
 import pandas as pd
-from translate_colors import TranslateColors
-from roi_info import LEGACY_MISSPELLED_ROIS, ROIInfo
+from roi_info import LEGACY_MISSPELLED_ROIS
+from atlas_registry import AtlasRegistry
 from tracers_and_regions import TracersAndRegions
 
 
 class CsvParser(object):
     __metaclass__ = ABCMeta
 
-    def __init__(self, csv_path):
+    # meta_info: if given (e.g. loaded from LevelConnectivityCache), the csv
+    # file is not read until its data block is requested
+    def __init__(self, csv_path, meta_info=None):
         if not os.path.isfile(csv_path):
             raise ValueError('{} is not a file'.format(csv_path))
         self._csv_path = csv_path
         self._meta_info = CsvParser.init_meta_info()
         # search maximum of 20 lines for metalines
         self._max_metalines = 20
-        self.parse_metalines()
-        self.assert_supported()
+        # text following the metaline end token. None if the token is not found
+        self._data_block = None
+        if meta_info is None:
+            self.read_csv()
+            self.assert_supported()
+        else:
+            self._meta_info.update(meta_info)
 
     @staticmethod
     def init_meta_info():
@@ -46,6 +55,9 @@ class CsvParser(object):
     def _metaline_end_token(self):
         pass
 
+    def meta_info(self):
+        return dict(self._meta_info)
+
     def equal_metalines(self, other):
         assert isinstance(other, CsvParser)
         return self._meta_info == other._meta_info
@@ -93,101 +105,231 @@ class CsvParser(object):
     def assert_supported(self):
         pass
 
-    def parse_metalines(self):
+    # read lines of f up to the metaline end token, a str or a tuple of str.
+    # returns the metalines and whether the token was found, in which case f is
+    # positioned after the token line. readline rather than iteration, so that
+    # f.tell() stays available
+    def _read_metalines(self, f):
+        end_token = self._metaline_end_token()
+        metalines = []
+        for l in iter(f.readline, ''):
+            if end_token is not None and l.startswith(end_token):
+                return metalines, True
+            metalines.append(l)
+            if len(metalines) == self._max_metalines:
+                break
+        return metalines, False
+
+    def read_csv(self):
+        """
+        single pass over the csv file. lines before the metaline end token are
+        parsed as metalines, the remainder of the file is kept in
+        self._data_block until consumed by the data parser
+        """
+        with open(self._csv_path, 'r') as f:
+            metalines, token_found = self._read_metalines(f)
+            if token_found:
+                self._data_block = f.read()
+        self.parse_metalines(metalines)
+
+    def parse_metalines(self, metalines):
         n = 0
+        for l in metalines:
+            if n == self._max_metalines:
+                break
+            kv = l.strip().split(':')
+            if len(kv) != 2:
+                continue
+            key, value = kv
+            if key in self._meta_info:
+                self._meta_info[key] = value.strip()
+            n += 1
+
+    # return the data block and release it from the parser. if the block has
+    # already been consumed, the csv file is read again
+    def _consume_data_block(self):
+        if self._data_block is None:
+            self.read_csv()
+            self.assert_supported()
+        data_block, self._data_block = self._data_block, None
+        return data_block
+
+
+class MetaCsvParser(CsvParser):
+    """
+    metalines of a roi or grid overlap csv file. the data block is never read,
+    so no atlas is loaded. meant for inspecting csv files cheaply, e.g. by
+    CorpusIndex, before the matching data parser is constructed
+    """
+    def _metaline_end_token(self):
+        return RoiCsvParser.METALINE_END_TOKEN, GridCsvParser.METALINE_END_TOKEN
+
+    def read_csv(self):
         with open(self._csv_path, 'r') as f:
-            for l in f:
-                if n == self._max_metalines:
-                    break
-                kv = l.strip().split(':')
-                if len(kv) != 2:
-                    continue
-                key, value = kv
-                if key in self._meta_info:
-                    self._meta_info[key] = value.strip()
-                n += 1
+            metalines, _ = self._read_metalines(f)
+        self.parse_metalines(metalines)
 
 
 class RoiCsvParser(CsvParser):
-    def __init__(self, csv_path):
-        super(RoiCsvParser, self).__init__(csv_path)
-        self.rgb_codec = TranslateColors(custom_atlas=self.custom_atlas())
-        self.roi_info = ROIInfo(self.rgb_codec)
+    METALINE_END_TOKEN = '(HEMISPHERE:R:G:B)'
+
+    def __init__(self, csv_path, meta_info=None):
+        super(RoiCsvParser, self).__init__(csv_path, meta_info=meta_info)
+        self.rgb_codec = AtlasRegistry.rgb_codec(self.custom_atlas())
+        self.roi_info = AtlasRegistry.roi_info(self.custom_atlas())
+        self.lookup = AtlasRegistry.lookup(self.custom_atlas())
 
     # if (HEMISPHERE:R:G:B) not found, the file's version is old and unsupported
     def _metaline_end_token(self):
-        return '(HEMISPHERE:R:G:B)'
+        return RoiCsvParser.METALINE_END_TOKEN
 
-    # search maximum of 20 lines for metaline end token
+    # metaline end token must be found within the first 20 lines
     def assert_supported(self):
         assert self.is_roi_mode(), '{} is not roi based'.format(self._csv_path)
-        n = 0
-        with open(self._csv_path, 'r') as f:
-            for l in f:
-                if l.startswith(self._metaline_end_token()):
-                    return
-                n += 1
-                if n == self._max_metalines:
-                    raise ValueError('the roi overlap is from an older unsupported '
-                                     'version of connection lens. please re-run overlap')
+        if self._data_block is None:
+            raise ValueError('the roi overlap is from an older unsupported '
+                             'version of connection lens. please re-run overlap')
 
     def known_roi(self, roi):
         roi = roi.strip()
         return roi in self.roi_info.roi2index or roi in LEGACY_MISSPELLED_ROIS
 
+    def parse_data_arrays(self):
+        """
+        parse the (HEMISPHERE:R:G:B) data block into typed numpy arrays
+        lines with unknown rois are discarded, legacy misspelled roi names are
+        corrected and overlap is forced to zero where area is zero
+        :return: dict with keys hemisphere, r, g, b, atlas_only, overlap, region
+        """
+        # (l:31:156:88), 1023902, 9, MOs_5 -> l,31,156,88, 1023902, 9, MOs_5
+        data_block = self._consume_data_block()
+        data_block = data_block.replace('(', '').replace(')', '').replace(':', ',')
+        lines = [l for l in data_block.splitlines() if l.strip()]
+        n_fields = 7
+        fields = ','.join(lines).split(',') if lines else []
+        if len(fields) != n_fields * len(lines):
+            raise ValueError('malformed data line encountered in {}'.format(self._csv_path))
+
+        region = np.array([roi.strip() for roi in fields[6::n_fields]], dtype=object)
+        known_rois = (self.lookup.roi_ids(region) >= 0) | np.isin(region, list(LEGACY_MISSPELLED_ROIS))
+        if not known_rois.all():
+            for roi in region[~known_rois]:
+                warnings.warn("unknown roi {} encountered, discarding line".format(roi), RuntimeWarning)
+        region = np.array([LEGACY_MISSPELLED_ROIS.get(roi, roi) for roi in region], dtype=object)[known_rois]
+        hemisphere = np.array([hemi.strip() for hemi in fields[0::n_fields]], dtype=object)[known_rois]
+        r = np.array(fields[1::n_fields], dtype=np.uint8)[known_rois]
+        g = np.array(fields[2::n_fields], dtype=np.uint8)[known_rois]
+        b = np.array(fields[3::n_fields], dtype=np.uint8)[known_rois]
+        atlas_only = np.array(fields[4::n_fields], dtype=np.float64)[known_rois]
+        overlap = np.array(fields[5::n_fields], dtype=np.float64)[known_rois]
+
+        zero_area = (atlas_only + overlap) == 0
+        for roi in region[zero_area]:
+            warnings.warn("area of {} at {} level {} is zero. forcing overlap to zero. "
+                          .format(roi, self.custom_atlas(), self.ara_level_str()),
+                          RuntimeWarning)
+        overlap = np.where(zero_area, 0., overlap)
+        return {
+            'hemisphere': hemisphere,
+            'r': r,
+            'g': g,
+            'b': b,
+            'atlas_only': atlas_only,
+            'overlap': overlap,
+            'region': region
+        }
+
     def parse_data(self):
         """
         return a dataframe with following columns parsed from csv file
         hemisphere, atlas_only, overlap, region
         :return:
         """
-        data = {
-            'hemisphere': [],
-            'atlas_only': [],
-            'overlap': [],
-            'region': []
-        }
-        is_dataline = False
-        with open(self._csv_path, 'r') as f:
-            for l in f:
-                if l.startswith(self._metaline_end_token()):
-                    is_dataline = True
-                    continue
-                if not is_dataline:
-                    continue
-                hemi_rgb, atlas_only, overlap, region = l.strip().split(',')
-                region = region.strip()
-                hemi, r, g, b = hemi_rgb.strip()[1:-1].split(':')
-                atlas_only = float(atlas_only)
-                overlap = float(overlap)
-                area = atlas_only + overlap
-                if not self.known_roi(region):
-                    warnings.warn("unknown roi {} encountered, discarding line".format(region),
-                                  RuntimeWarning)
-                    continue
-                if region in LEGACY_MISSPELLED_ROIS:
-                    region = LEGACY_MISSPELLED_ROIS[region]
-                if area == 0:
-                    warnings.warn("area of {} at {} level {} is zero. forcing overlap to zero. "
-                                  .format(region, self.custom_atlas(), self.ara_level_str()),
-                                  RuntimeWarning)
-                    overlap = 0
-                data['hemisphere'].append(hemi)
-                data['atlas_only'].append(atlas_only)
-                data['overlap'].append(overlap)
-                data['region'].append(region)
-        return pd.DataFrame(data=data)
+        data = self.parse_data_arrays()
+        return pd.DataFrame(data={column: data[column]
+                                  for column in ['hemisphere', 'atlas_only', 'overlap', 'region']})
 
 
 class GridCsvParser(CsvParser):
-    def __init__(self, csv_path):
-        super(GridCsvParser, self).__init__(csv_path)
-        self._meta_info['Grid Size'] = None
-        # supported criteria TBD
+    """
+    grid overlap csv file: metalines, the (ROW:COL) token line, then one line
+    per grid cell of 'Grid Size' pixels
+        (row:col), atlas_only, overlap
+    grid files can hold millions of cells. the data block is never held in
+    memory as a whole, iter_data_arrays parses it in chunks of CHUNK_LINES lines
+    """
+    METALINE_END_TOKEN = '(ROW:COL)'
+    CHUNK_LINES = 1 << 16
+    N_FIELDS = 4
+
+    def __init__(self, csv_path, meta_info=None):
+        # offset of the first data line in the csv file. None if the token is not found
+        self._data_offset = None
+        super(GridCsvParser, self).__init__(csv_path, meta_info=meta_info)
 
     def _metaline_end_token(self):
-        pass
+        return GridCsvParser.METALINE_END_TOKEN
 
     def assert_supported(self):
-        pass
+        assert not self.is_roi_mode(), '{} is not grid based'.format(self._csv_path)
+        if self._data_offset is None:
+            raise ValueError('the grid overlap is from an older unsupported '
+                             'version of connection lens. please re-run overlap')
+
+    def grid_size(self):
+        return int(self._meta_info['Grid Size'])
 
+    def read_csv(self):
+        """
+        parse metalines and record where the data lines start. unlike
+        CsvParser.read_csv, the data lines are not read
+        """
+        with open(self._csv_path, 'r') as f:
+            metalines, token_found = self._read_metalines(f)
+            if token_found:
+                self._data_offset = f.tell()
+        self.parse_metalines(metalines)
+
+    def iter_data_arrays(self):
+        """
+        parse the (ROW:COL) data block chunk by chunk. cells with zero area
+        are discarded, overlap is forced to zero where area is zero
+        :return: generator of dicts with keys row, col (int64), atlas_only, overlap (float64)
+        """
+        if self._data_offset is None:
+            self.read_csv()
+            self.assert_supported()
+        with open(self._csv_path, 'r') as f:
+            f.seek(self._data_offset)
+            while True:
+                lines = list(itertools.islice(f, GridCsvParser.CHUNK_LINES))
+                if len(lines) == 0:
+                    break
+                lines = [l for l in lines if l.strip()]
+                if len(lines) > 0:
+                    yield self._parse_lines(lines)
+
+    def _parse_lines(self, lines):
+        # (12:40), 1023902, 9 -> 12,40, 1023902, 9
+        n_fields = GridCsvParser.N_FIELDS
+        fields = ','.join([l.strip() for l in lines]).replace('(', '').replace(')', '').replace(':', ',').split(',')
+        if len(fields) != n_fields * len(lines):
+            raise ValueError('malformed data line encountered in {}'.format(self._csv_path))
+        row = np.array(fields[0::n_fields], dtype=np.int64)
+        col = np.array(fields[1::n_fields], dtype=np.int64)
+        atlas_only = np.array(fields[2::n_fields], dtype=np.float64)
+        overlap = np.array(fields[3::n_fields], dtype=np.float64)
+
+        # cells outside the atlas carry no information
+        zero_area = (atlas_only + overlap) == 0
+        if (overlap[zero_area] != 0).any():
+            warnings.warn("area of {} grid cells at {} level {} is zero. forcing overlap to zero. "
+                          .format(np.count_nonzero(overlap[zero_area]), self.custom_atlas(), self.ara_level_str()),
+                          RuntimeWarning)
+        keep = ~zero_area
+        return {
+            'row': row[keep],
+            'col': col[keep],
+            'atlas_only': atlas_only[keep],
+            'overlap': overlap[keep]
+        }
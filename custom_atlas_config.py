@@ -3,11 +3,15 @@ import os
 import warnings
 import enum
 import json
+import threading
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
+import pandas as pd
 import cv2
 from translate_colors import TranslateColors
 from translate_colors import UnknownCustomAtlasError
-from roi_info import ROIInfo, INDEX2ROI
+from roi_info import INDEX2ROI
+from atlas_registry import AtlasRegistry
 
 
 class AtlasAssetType(enum.Enum):
@@ -16,9 +20,9 @@ class AtlasAssetType(enum.Enum):
     AnnotatedBWAtlas = 3
     AnnotatedColorAtlas = 4
 
-    def asset_dir(self, custom_atlas="ARA"):
+    def asset_dir(self, custom_atlas="ARA", root_dir=None):
         CustomAtlasConfig.assert_is_valid_atlas(custom_atlas)
-        root = self.asset_root_dir()
+        root = self.asset_root_dir() if root_dir is None else root_dir
         subdir = CustomAtlasConfig.atlas_subdir(custom_atlas)
         return os.path.join(root, subdir)
 
@@ -52,8 +56,8 @@ class AtlasAssetType(enum.Enum):
         else:
             return level + basename
 
-    def asset_path(self, custom_atlas, level, local=True):
-        asset_dir = self.asset_dir(custom_atlas=custom_atlas)
+    def asset_path(self, custom_atlas, level, root_dir=None):
+        asset_dir = self.asset_dir(custom_atlas=custom_atlas, root_dir=root_dir)
         asset_name = self.asset_name(custom_atlas=custom_atlas, level=level)
         ret_path = os.path.join(asset_dir, asset_name)
         return ret_path
@@ -62,7 +66,7 @@ class AtlasAssetType(enum.Enum):
 class CustomAtlasConfig:
     """
     CustomAtlasConfig class
-    holds TranslateColors and ROIInfo class instantiated from custom_atlas
+    holds the TranslateColors and ROIInfo instances registered for custom_atlas
     can also act as a filter to select desired roi to include in analysis.
     maybe interface with ui. placeholder for now
     """
@@ -132,8 +136,10 @@ class CustomAtlasConfig:
     def __init__(self, custom_atlas=DEFAULT_ATLAS):
         self.assert_is_valid_atlas(custom_atlas)
         self._associated_atlas = custom_atlas
-        self.rgb_codec = TranslateColors(self._associated_atlas)
-        self.roi_info = ROIInfo(self.rgb_codec)
+        # shared with all other users of the atlas, see AtlasRegistry
+        self.rgb_codec = AtlasRegistry.rgb_codec(self._associated_atlas)
+        self.roi_info = AtlasRegistry.roi_info(self._associated_atlas)
+        self.lookup = AtlasRegistry.lookup(self._associated_atlas)
         self.version = CustomAtlasConfig.CUSTOM_ATLAS_STABLE_VER[self._associated_atlas]
         self.filtered = False
 
@@ -206,16 +212,17 @@ class CustomAtlasConfig:
             level, asset_type, custom_atlas)
 
     @staticmethod
-    def gen_atlas_path(level, custom_atlas="ARA"):
+    def gen_atlas_path(level, custom_atlas="ARA", root_dir=None):
         """
         generate atlas path for level and specified custom atlas
         if no atlas defined for given level and custom atlas combination,
         return custom_atlas, path to ara atlas
         otherwise, return ARA, path to custom atlas
+        root_dir: local directory laid out as ATLAS_COMMON_DIR, which is used if None
         """
         asset_type = AtlasAssetType.RGBAtlas
         return CustomAtlasConfig.gen_level_asset_atlas_path(
-            level, asset_type, custom_atlas)
+            level, asset_type, custom_atlas, root_dir=root_dir)
 
     @staticmethod
     def gen_ann_bw_path(level, custom_atlas="ARA"):
@@ -242,14 +249,14 @@ class CustomAtlasConfig:
             level, asset_type, custom_atlas)
 
     @staticmethod
-    def gen_level_asset_atlas_path(level, asset_type, custom_atlas):
+    def gen_level_asset_atlas_path(level, asset_type, custom_atlas, root_dir=None):
         CustomAtlasConfig.assert_is_valid_atlas(custom_atlas)
         level = CustomAtlasConfig.clean_level_str(level)
-        atlas_path = asset_type.asset_path(custom_atlas, level)
+        atlas_path = asset_type.asset_path(custom_atlas, level, root_dir=root_dir)
         if os.path.isfile(atlas_path):
             return custom_atlas, atlas_path
         else:
-            atlas_path = asset_type.asset_path('ARA', level)
+            atlas_path = asset_type.asset_path('ARA', level, root_dir=root_dir)
             assert os.path.isfile(atlas_path), "Cannot Generate Asset"
             return "ARA", atlas_path
 
@@ -290,67 +297,234 @@ class CustomAtlasConfig:
             raise UnknownCustomAtlasError(custom_atlas)
 
     @staticmethod
-    def get_level_rois(level, custom_atlas='ARA', bilateral=True):
-        if not 1 <= level <= 132:
+    def get_level_rois(level, custom_atlas='ARA', bilateral=True, root_dir=None):
+        """
+        :return: set of the names of the rois present at level, as <roi>_ipsi
+                 and <roi>_contra if bilateral. see LevelRoiIndex
+        """
+        if not 1 <= level <= AtlasLevelScan.N_LEVELS:
             raise ValueError('atlas level out of range')
-        level_str = '0' * (3 - len(str(level))) + str(level)
-        atlas_dir = os.path.join(CustomAtlasConfig.ATLAS_COMMON_DIR,
-                                 CustomAtlasConfig
-                                 .CUSTOM_ATLAS_SUBDIR[custom_atlas])
-        atlas_level_rois_json_path = os.path.join(
-            atlas_dir, '{}_level_rois.json'.format(custom_atlas))
-        with open(atlas_level_rois_json_path, 'r') as f:
-            m = json.load(f)
-        level_rois = set()
-        if bilateral:
-            for roi in m[level_str]:
-                level_rois.add('{}_ipsi'.format(roi))
-                level_rois.add('{}_contra'.format(roi))
-        else:
-            level_rois = set(m[level_str])
-        return level_rois
+        level_roi_index = LevelRoiIndex.get(custom_atlas, root_dir=root_dir)
+        return set(level_roi_index.rois_in_levels([level], bilateral=bilateral).tolist())
 
     @staticmethod
-    def _get_rgb_code_levels(rgb_indices, custom_atlas='ARA'):
-        rgb_indices_level_mappings = {}
-        for rgb_index in rgb_indices:
-            rgb_indices_level_mappings[rgb_index] = []
-        for level in range(1, 133):
-            print(level)
-            _, atlas_path = CustomAtlasConfig.gen_atlas_path(level, custom_atlas)
-            rgb_atlas = cv2.imread(atlas_path, -1)
-            index_atlas = TranslateColors.rgbatlas_to_indexatlas(rgb_atlas)
-            unique_indices = set(np.unique(index_atlas))
-            for rgb_index in rgb_indices:
-                if rgb_index in unique_indices:
-                    rgb_indices_level_mappings[rgb_index].append(level)
-                    print('found {}: {} at custom atlas {} level {}'
-                          .format(rgb_index, INDEX2ROI[rgb_index],
-                                  custom_atlas, level))
-        return rgb_indices_level_mappings
+    def _get_rgb_code_levels(rgb_indices, custom_atlas='ARA', root_dir=None, n_workers=None):
+        """
+        :return: dict, rgb index -> list of the levels its color is found at
+        see AtlasLevelScan for root_dir and n_workers
+        """
+        level_scan = AtlasLevelScan(custom_atlas, root_dir=root_dir, n_workers=n_workers).run()
+        return level_scan.levels_of(rgb_indices)
 
     @staticmethod
-    def _build_custom_atlas_level_roi(custom_atlas='ARA'):
-        if custom_atlas not in TranslateColors.CUSTOM_ATLAS_LOOKUP:
-            raise UnknownCustomAtlasError(custom_atlas)
-        out_dir = os.path.join(CustomAtlasConfig.ATLAS_COMMON_DIR,
-                               CustomAtlasConfig
-                               .CUSTOM_ATLAS_SUBDIR[custom_atlas])
+    def _build_custom_atlas_level_roi(custom_atlas='ARA', root_dir=None, n_workers=None):
+        """
+        write <custom_atlas>_level_rois.json next to the rgb atlas images: the
+        rois found at each level, by zero padded level string
+        see AtlasLevelScan for root_dir and n_workers
+        """
+        level_scan = AtlasLevelScan(custom_atlas, root_dir=root_dir, n_workers=n_workers).run()
+        out_dir = AtlasAssetType.RGBAtlas.asset_dir(custom_atlas, root_dir=root_dir)
         out_path = os.path.join(out_dir,
                                 '{}_level_rois.json'.format(custom_atlas))
         level_rois = {}
-        for level in range(1, 133):
-            _, atlas_path = CustomAtlasConfig.gen_atlas_path(level,
-                                                             custom_atlas)
-            level_str = '0' * (3 - len(str(level))) + str(level)
-            print('custom atlas {} level {}: {}'
-                  .format(custom_atlas, level_str, atlas_path))
-            rgb_atlas = cv2.imread(atlas_path, -1)
-            index_atlas = TranslateColors.rgbatlas_to_indexatlas(rgb_atlas)
-            unique_indices = np.unique(index_atlas)
-            unique_rois = [INDEX2ROI[unique_index]
-                           for unique_index in unique_indices]
-            print(unique_rois)
-            level_rois[level_str] = unique_rois
+        for level in level_scan.levels:
+            level_rois[CustomAtlasConfig.clean_level_str(int(level))] = [
+                INDEX2ROI[rgb_index] for rgb_index in level_scan.rgb_indices_at(level).tolist()]
         with open(out_path, 'w') as f:
             json.dump(level_rois, f, indent=1, sort_keys=True)
+        LevelRoiIndex.clear(custom_atlas, root_dir=root_dir)
+
+
+class LevelRoiIndex:
+    """
+    LevelRoiIndex class:
+    rois present at each level of a custom atlas, read once per atlas from
+    <custom_atlas>_level_rois.json (see CustomAtlasConfig._build_custom_atlas_level_roi)
+    and shared process wide. rois are numbered by ids in ascending roi name order
+       levels: int64 array, 1 to AtlasLevelScan.N_LEVELS, rows of presence
+       roi_names: object array, roi id -> roi name
+       presence: read only bool array (level, roi id), roi is present at level
+    queries are vectorized over levels and rois, e.g. to tell rois with no
+    connectivity at the sectioned levels apart from rois absent there
+    """
+    BILATERAL_SUFFIXES = ('_ipsi', '_contra')
+    _indices = {}
+    _lock = threading.Lock()
+
+    def __init__(self, level_rois):
+        """
+        :param level_rois: dict, zero padded level string -> list of roi names
+        """
+        self.levels = np.arange(1, AtlasLevelScan.N_LEVELS + 1)
+        self.roi_names = np.array(sorted(set(roi for rois in level_rois.values() for roi in rois)), dtype=object)
+        self.roi_name_dtype = pd.CategoricalDtype(self.roi_names)
+        self.presence = np.zeros((len(self.levels), len(self.roi_names)), dtype=bool)
+        for level_str, rois in level_rois.items():
+            level = int(level_str)
+            if not 1 <= level <= AtlasLevelScan.N_LEVELS:
+                raise ValueError('atlas level {} out of range'.format(level_str))
+            self.presence[level - 1, self.roi_ids(rois)] = True
+        self.bilateral_names = np.array([[roi + suffix for suffix in LevelRoiIndex.BILATERAL_SUFFIXES]
+                                         for roi in self.roi_names], dtype=object).reshape(-1, 2)
+        for index_array in [self.roi_names, self.presence, self.bilateral_names]:
+            index_array.setflags(write=False)
+
+    @staticmethod
+    def json_path(custom_atlas, root_dir=None):
+        atlas_dir = AtlasAssetType.RGBAtlas.asset_dir(custom_atlas, root_dir=root_dir)
+        return os.path.join(atlas_dir, '{}_level_rois.json'.format(custom_atlas))
+
+    @classmethod
+    def get(cls, custom_atlas='ARA', root_dir=None):
+        """
+        :return: LevelRoiIndex of custom_atlas, loaded on first request
+        """
+        key = (custom_atlas, root_dir)
+        with cls._lock:
+            if key not in cls._indices:
+                with open(LevelRoiIndex.json_path(custom_atlas, root_dir=root_dir), 'r') as f:
+                    cls._indices[key] = cls(json.load(f))
+            return cls._indices[key]
+
+    @classmethod
+    def clear(cls, custom_atlas=None, root_dir=None):
+        """
+        drop the cached index of custom_atlas, of all atlases if None
+        """
+        with cls._lock:
+            if custom_atlas is None:
+                cls._indices.clear()
+            else:
+                cls._indices.pop((custom_atlas, root_dir), None)
+
+    def roi_ids(self, roi_names):
+        """ :return: int64 array of the roi ids of roi_names, -1 for rois absent at every level """
+        return pd.Categorical(np.asarray(roi_names, dtype=object), dtype=self.roi_name_dtype).codes.astype(np.int64)
+
+    def _rows(self, levels):
+        levels = np.asarray(levels, dtype=np.int64)
+        if ((levels < 1) | (levels > AtlasLevelScan.N_LEVELS)).any():
+            raise ValueError('atlas level out of range')
+        return levels - 1
+
+    def rois_in_levels(self, levels, bilateral=False):
+        """
+        :return: object array of the names of the rois present at any of levels,
+                 ascending. if bilateral, <roi>_ipsi and <roi>_contra of each
+                 roi instead, by ascending roi name, then ipsi before contra
+        """
+        present = self.presence[self._rows(levels)].any(axis=0)
+        if bilateral:
+            return self.bilateral_names[present].ravel()
+        return self.roi_names[present]
+
+    def levels_with_rois(self, roi_names):
+        """
+        :return: int64 array of the levels at which any of roi_names is present
+        """
+        roi_ids = self.roi_ids(roi_names)
+        return self.levels[self.presence[:, roi_ids[roi_ids >= 0]].any(axis=1)]
+
+    def present_in_levels(self, roi_names, levels):
+        """
+        :return: bool array aligned to roi_names, whether the roi is present at
+                 any of levels. false for rois unknown to the index
+        """
+        roi_ids = self.roi_ids(roi_names)
+        present = self.presence[self._rows(levels)].any(axis=0)
+        if len(present) == 0:
+            # no rois in the index
+            return np.zeros(len(roi_ids), dtype=bool)
+        return (roi_ids >= 0) & present.take(np.maximum(roi_ids, 0))
+
+
+# rgb indices of the colors in the rgb atlas image at atlas_path, ascending,
+# and their pixel counts. module level so that it can be sent to worker processes
+def _scan_level(atlas_path):
+    rgb_atlas = cv2.imread(atlas_path, -1)
+    if rgb_atlas is None:
+        raise ValueError('cannot read atlas image {}'.format(atlas_path))
+    index_atlas = TranslateColors.rgbatlas_to_indexatlas(rgb_atlas)
+    return np.unique(index_atlas, return_counts=True)
+
+
+class AtlasLevelScan:
+    """
+    AtlasLevelScan class:
+    reads the rgb atlas image of every level of a custom atlas once, as
+    CustomAtlasConfig.gen_atlas_path resolves them (levels with no custom
+    atlas image fall back to ARA), and tabulates the colors found
+    results, after run:
+       levels: int64 array, the scanned levels, rows of the matrices below
+       rgb_indices: int64 array, ascending rgb indices found at any level, columns of the matrices below
+       pixel_counts: int64 array (level, rgb_index), number of pixels of each color at each level
+       presence: bool array (level, rgb_index), pixel_counts > 0
+    root_dir: local directory laid out as CustomAtlasConfig.ATLAS_COMMON_DIR,
+    which is used if None
+    n_workers: if None or 1, levels are scanned in process, otherwise in a pool
+    of n_workers processes
+    """
+    N_LEVELS = 132
+
+    def __init__(self, custom_atlas='ARA', levels=None, root_dir=None, n_workers=None):
+        CustomAtlasConfig.assert_is_valid_atlas(custom_atlas)
+        if levels is None:
+            levels = range(1, AtlasLevelScan.N_LEVELS + 1)
+        self.custom_atlas = custom_atlas
+        self.levels = np.array(levels, dtype=np.int64)
+        if ((self.levels < 1) | (self.levels > AtlasLevelScan.N_LEVELS)).any():
+            raise ValueError('atlas level out of range')
+        self.root_dir = root_dir
+        self.n_workers = n_workers
+        self.rgb_indices = None
+        self.pixel_counts = None
+        self.presence = None
+
+    def run(self):
+        """
+        :return: self, with the results set
+        """
+        atlas_paths = [CustomAtlasConfig.gen_atlas_path(int(level), self.custom_atlas, root_dir=self.root_dir)[1]
+                       for level in self.levels]
+        if self.n_workers is None or self.n_workers <= 1:
+            level_colors = [_scan_level(atlas_path) for atlas_path in atlas_paths]
+        else:
+            with ProcessPoolExecutor(max_workers=self.n_workers) as executor:
+                level_colors = list(executor.map(_scan_level, atlas_paths))
+        if len(level_colors) > 0:
+            self.rgb_indices = np.unique(np.concatenate([rgb_indices for rgb_indices, _ in level_colors]))
+        else:
+            self.rgb_indices = np.zeros(0, dtype=np.int64)
+        self.rgb_indices = self.rgb_indices.astype(np.int64)
+        self.pixel_counts = np.zeros((len(self.levels), len(self.rgb_indices)), dtype=np.int64)
+        for row, (rgb_indices, counts) in enumerate(level_colors):
+            self.pixel_counts[row, np.searchsorted(self.rgb_indices, rgb_indices)] = counts
+        self.presence = self.pixel_counts > 0
+        return self
+
+    def _assert_scanned(self):
+        assert self.presence is not None, 'levels are not scanned yet, see AtlasLevelScan.run'
+
+    def levels_of(self, rgb_indices):
+        """
+        :return: dict, rgb index -> list of the scanned levels its color is found at
+        """
+        self._assert_scanned()
+        rgb_indices = np.asarray(rgb_indices, dtype=np.int64)
+        columns = np.minimum(np.searchsorted(self.rgb_indices, rgb_indices), max(len(self.rgb_indices) - 1, 0))
+        found = np.zeros(len(rgb_indices), dtype=bool)
+        if len(self.rgb_indices) > 0:
+            found = self.rgb_indices[columns] == rgb_indices
+        return dict((rgb_index, self.levels[self.presence[:, column]].tolist() if is_found else [])
+                    for rgb_index, column, is_found in zip(rgb_indices.tolist(), columns, found))
+
+    def rgb_indices_at(self, level):
+        """
+        :return: int64 array, ascending rgb indices of the colors found at level
+        """
+        self._assert_scanned()
+        rows = np.flatnonzero(self.levels == level)
+        if len(rows) == 0:
+            raise ValueError('level {} was not scanned'.format(level))
+        return self.rgb_indices[self.presence[rows[0]]]
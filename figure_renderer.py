@@ -0,0 +1,72 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+# runs once in each worker process, before any figure is drawn
+def _init_worker():
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+# draw a figure and save it. module level so that it can be sent to worker processes
+def _render(draw, save_path, args, kwargs):
+    import matplotlib.pyplot as plt
+    drawn = draw(*args, **kwargs)
+    # seaborn grids keep their figure in the fig attribute and save through their own savefig
+    figure = getattr(drawn, 'fig', drawn)
+    figure.set_size_inches(*FigureRenderer.FIGURE_SIZE)
+    drawn.savefig(save_path)
+    plt.close(figure)
+    return save_path
+
+
+class FigureRenderer:
+    """
+    FigureRenderer class:
+    renders figure descriptions to image files without any gui interaction.
+    a figure description is a picklable draw function, its arguments and the
+    path to save to. draw returns the matplotlib figure, or a seaborn grid.
+    figures are saved at FigureRenderer.FIGURE_SIZE inches, the size of a
+    maximized 1920x1080 window at 100 dpi
+    n_workers: if None or 1, figures are rendered by submit, in the calling
+    process and with its matplotlib backend. otherwise figures are rendered
+    concurrently by a pool of n_workers processes using the Agg backend, and
+    wait() blocks until all submitted figures are written. worker processes are
+    spawned rather than forked, so they never inherit a gui backend's state
+    """
+    FIGURE_SIZE = (19.2, 10.8)
+
+    def __init__(self, n_workers=None):
+        self.n_workers = n_workers
+        self._executor = None
+        if self.n_workers is not None and self.n_workers > 1:
+            self._executor = ProcessPoolExecutor(max_workers=self.n_workers,
+                                                 mp_context=multiprocessing.get_context('spawn'),
+                                                 initializer=_init_worker)
+        # save paths of figures rendered in process, futures of figures sent to the pool
+        self._submitted = []
+
+    def submit(self, draw, save_path, *args, **kwargs):
+        if self._executor is None:
+            self._submitted.append(_render(draw, save_path, args, kwargs))
+        else:
+            self._submitted.append(self._executor.submit(_render, draw, save_path, args, kwargs))
+
+    def wait(self):
+        """
+        block until all submitted figures are written. if any figure failed to
+        render, the first error is raised once all figures are done
+        :return: paths of the figures written since the last call, in submission order
+        """
+        submitted, self._submitted = self._submitted, []
+        errors = [future.exception() for future in submitted if not isinstance(future, str)]
+        for error in errors:
+            if error is not None:
+                raise error
+        return [future if isinstance(future, str) else future.result() for future in submitted]
+
+    def close(self):
+        if self._executor is not None:
+            self.wait()
+            self._executor.shutdown()
+            self._executor = None
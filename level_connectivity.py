@@ -1,7 +1,8 @@
 import os.path
-from translate_colors import TranslateColors
-from roi_info import ROIInfo
-from csv_parser import RoiCsvParser
+import numpy as np
+import pandas as pd
+from atlas_registry import AtlasRegistry
+from csv_parser import RoiCsvParser, GridCsvParser
 
 
 class LevelConnectivity:
@@ -9,20 +10,71 @@ class LevelConnectivity:
     csv_parser: RoiCsvParser object
     df: 'rgb_index', 'hemisphere', 'atlas_only', 'overlap', 'area'
     df_grey_matter: rows of df which belong to grey matter
+    meta_info, df: if both given (e.g. loaded from LevelConnectivityCache), the
+    csv file is not parsed
     """
-    def __init__(self, csv_path):
+    def __init__(self, csv_path, meta_info=None, df=None):
         assert os.path.isfile(csv_path), "{} does not exist".format(csv_path)
-        self.csv_parser = RoiCsvParser(csv_path)
-        self.roi_info = ROIInfo(TranslateColors(custom_atlas=self.csv_parser.custom_atlas()))
-        self.df = self.csv_parser.parse_data()
-        self.df['area'] = self.df['atlas_only'] + self.df['overlap']
-        self.df['rgb_index'] = self.df['region'].apply(lambda roi: self.roi_info.roi2index[roi])
+        self.csv_parser = RoiCsvParser(csv_path, meta_info=meta_info)
+        self.roi_info = AtlasRegistry.roi_info(self.csv_parser.custom_atlas())
+        self.lookup = AtlasRegistry.lookup(self.csv_parser.custom_atlas())
+        if df is not None:
+            self.df = df
+        else:
+            self.df = self.csv_parser.parse_data()
+            self.df['area'] = self.df['atlas_only'] + self.df['overlap']
+            self.df['rgb_index'] = self.lookup.rgb_index_of(self.df['region'].values)
 
     # returns the columns rgb_index, hemisphere, overlap, area
     def connectivity(self, grey_matter=True):
         if grey_matter:
-            return self.df.loc[self.df['rgb_index'].isin(self.roi_info.gray_matter_indices),
+            return self.df.loc[self.lookup.is_gray_matter(self.df['rgb_index'].values),
                                ['rgb_index', 'hemisphere', 'overlap', 'area']]
         else:
             return self.df[['rgb_index', 'hemisphere', 'overlap', 'area']]
 
+
+class GridLevelConnectivity:
+    """
+    csv_parser: GridCsvParser object
+    grid cells of a single ara level with non zero area, as sparse vectors
+       cell_ids: sorted unique cell ids, row * GridLevelConnectivity.CELL_ROW_STRIDE + col
+       overlap, area: float arrays aligned to cell_ids. cells listed more than once are summed
+    the csv file is parsed chunk by chunk, the grid is never expanded to dense arrays
+    """
+    # grids are expected to have less than CELL_ROW_STRIDE columns
+    CELL_ROW_STRIDE = 1 << 32
+
+    def __init__(self, csv_path, meta_info=None):
+        assert os.path.isfile(csv_path), "{} does not exist".format(csv_path)
+        self.csv_parser = GridCsvParser(csv_path, meta_info=meta_info)
+        cell_ids, overlaps, areas = [], [], []
+        for data in self.csv_parser.iter_data_arrays():
+            if (data['row'] < 0).any() or (data['col'] < 0).any() or \
+               (data['col'] >= GridLevelConnectivity.CELL_ROW_STRIDE).any():
+                raise ValueError('grid cell out of range in {}'.format(csv_path))
+            cell_ids.append(data['row'] * GridLevelConnectivity.CELL_ROW_STRIDE + data['col'])
+            overlaps.append(data['overlap'])
+            areas.append(data['atlas_only'] + data['overlap'])
+        cell_ids = np.concatenate(cell_ids) if cell_ids else np.zeros(0, dtype=np.int64)
+        self.cell_ids, cell_positions = np.unique(cell_ids, return_inverse=True)
+        self.overlap = np.bincount(cell_positions, weights=np.concatenate(overlaps) if overlaps else None,
+                                   minlength=len(self.cell_ids)).astype(np.float64)
+        self.area = np.bincount(cell_positions, weights=np.concatenate(areas) if areas else None,
+                                minlength=len(self.cell_ids)).astype(np.float64)
+
+    def rows(self):
+        return self.cell_ids // GridLevelConnectivity.CELL_ROW_STRIDE
+
+    def cols(self):
+        return self.cell_ids % GridLevelConnectivity.CELL_ROW_STRIDE
+
+    # returns the columns cell_id, row, col, overlap, area
+    def connectivity(self):
+        return pd.DataFrame({
+            'cell_id': self.cell_ids,
+            'row': self.rows(),
+            'col': self.cols(),
+            'overlap': self.overlap,
+            'area': self.area
+        })
@@ -0,0 +1,158 @@
+from __future__ import print_function
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
+
+
+class LevelConnectivityCache:
+    """
+    LevelConnectivityCache class:
+    on disk cache of parsed LevelConnectivity data frames and csv meta info.
+    csv files of one overlap directory share one npz entry under cache_dir,
+    named by the hash of the overlap directory's absolute path. an entry holds
+    the concatenated LevelConnectivity.df of its csv files as fields of a
+    structured array, and a json header with, for each csv file, its meta info,
+    its row range in the array and the key it was built from:
+        (absolute path, file size, mtime in ns, sha1 of file content)
+    a csv file's record is only used if its key matches the csv file on disk,
+    otherwise the csv file is treated as stale and should be parsed again
+    """
+    # bump when the layout of LevelConnectivity.df or the entry format changes
+    CACHE_VERSION = 1
+    STR_COLUMNS = ['hemisphere', 'region']
+    FLOAT_COLUMNS = ['atlas_only', 'overlap', 'area']
+    INT_COLUMNS = ['rgb_index']
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    @staticmethod
+    def csv_key(csv_path):
+        csv_path = os.path.abspath(csv_path)
+        stat = os.stat(csv_path)
+        sha1 = hashlib.sha1()
+        with open(csv_path, 'rb') as f:
+            sha1.update(f.read())
+        return {
+            'path': csv_path,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'sha1': sha1.hexdigest()
+        }
+
+    def entry_path(self, overlap_dir):
+        dir_hash = hashlib.sha1(os.path.abspath(overlap_dir).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, '{}.npz'.format(dir_hash))
+
+    def _read_entry(self, overlap_dir):
+        """
+        :return: (records, df) of the overlap directory's entry. records maps
+                 csv name to its header record. ({}, None) if no readable entry exists
+        """
+        entry_path = self.entry_path(overlap_dir)
+        if not os.path.isfile(entry_path):
+            return {}, None
+        try:
+            with np.load(entry_path, allow_pickle=False) as entry:
+                header = json.loads(str(entry['header']))
+                table = entry['table']
+        except (IOError, OSError, ValueError, KeyError):
+            # unreadable or partially written entry, treat as stale
+            return {}, None
+        if header['version'] != LevelConnectivityCache.CACHE_VERSION:
+            return {}, None
+        data = {}
+        for column in header['columns']:
+            if column in LevelConnectivityCache.STR_COLUMNS:
+                data[column] = table[column].astype(str).astype(object)
+            else:
+                data[column] = np.ascontiguousarray(table[column])
+        return header['records'], pd.DataFrame(data=data, columns=header['columns'])
+
+    def load(self, overlap_dir, csv_names):
+        """
+        :return: dict csv_name: (meta_info, df) for the csv files in csv_names
+                 with an up to date record. csv files missing from the dict
+                 need to be parsed
+        """
+        cached = {}
+        if len(csv_names) == 0:
+            return cached
+        records, df = self._read_entry(overlap_dir)
+        for csv_name in csv_names:
+            if csv_name not in records:
+                continue
+            record = records[csv_name]
+            if record['key'] != LevelConnectivityCache.csv_key(os.path.join(overlap_dir, csv_name)):
+                continue
+            level_df = df.iloc[record['start']: record['stop']].reset_index(drop=True)
+            cached[csv_name] = (record['meta_info'], level_df)
+        return cached
+
+    def store(self, overlap_dir, level_data):
+        """
+        add or replace records of the overlap directory's entry. records of
+        other csv files already in the entry are kept, unless their csv file
+        no longer exists, so that entries do not grow with deleted files
+        :param level_data: dict csv_name: (meta_info, df)
+        """
+        records, df = self._read_entry(overlap_dir)
+        level_dfs, new_records, start = [], {}, 0
+        for csv_name, record in records.items():
+            if csv_name in level_data or not os.path.isfile(os.path.join(overlap_dir, csv_name)):
+                continue
+            level_dfs.append(df.iloc[record['start']: record['stop']])
+            stop = start + record['stop'] - record['start']
+            new_records[csv_name] = dict(record, start=start, stop=stop)
+            start = stop
+        for csv_name, (meta_info, level_df) in level_data.items():
+            level_dfs.append(level_df)
+            stop = start + len(level_df)
+            new_records[csv_name] = {
+                'key': LevelConnectivityCache.csv_key(os.path.join(overlap_dir, csv_name)),
+                'meta_info': meta_info,
+                'start': start,
+                'stop': stop
+            }
+            start = stop
+        df = pd.concat(level_dfs, ignore_index=True)
+        header = {
+            'version': LevelConnectivityCache.CACHE_VERSION,
+            'columns': list(df.columns),
+            'records': new_records
+        }
+        # all columns of df are stored in a single structured array
+        columns = []
+        for column in df.columns:
+            if column in LevelConnectivityCache.STR_COLUMNS:
+                columns.append(df[column].values.astype('S'))
+            elif column in LevelConnectivityCache.FLOAT_COLUMNS:
+                columns.append(df[column].values.astype(np.float64))
+            elif column in LevelConnectivityCache.INT_COLUMNS:
+                columns.append(df[column].values.astype(np.int64))
+            else:
+                raise ValueError('column {} can not be cached'.format(column))
+        table = np.empty(len(df), dtype=[(column, values.dtype) for column, values in zip(df.columns, columns)])
+        for column, values in zip(df.columns, columns):
+            table[column] = values
+        # write to a temporary file then rename, so that concurrent readers
+        # never see a partially written entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez_compressed(f, header=np.array(json.dumps(header)), table=table)
+            os.replace(tmp_path, self.entry_path(overlap_dir))
+        except BaseException:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def clear(self):
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npz'):
+                os.remove(os.path.join(self.cache_dir, name))
@@ -9,22 +9,30 @@ from roi_groups import GLOBAL_COARSE_MAPPING, HY_COARSE_MAPPING, ROI_GROUPS, ROI
 from roi_info import INDEX2ROI
 from tracer_connectivity import TracerConnectivityBuilder
 from tracer_analysis import TracerAnalysis
+from figure_renderer import FigureRenderer
+from corpus_index import CorpusIndex
 
 
 # csv file references mouse brain cases, trailing commas removed
 case_sheet = pd.read_csv('case_sheet.csv', dtype={'channel': str}).set_index(['case_id', 'channel'])
+# parsed csv files are cached here. delete the directory to force re-parsing
+cache_dir = os.path.join(os.getcwd(), '.level_connectivity_cache')
 
 
-def get_connectivities(is_anterograde=True):
+def get_connectivities(is_anterograde=True, n_workers=None):
     overlap_dirs = []
     for case_id, channel in case_sheet.index:
         print(case_id, channel)
         overlap_dir = os.path.join(case_id, 'overlap', channel)
         assert os.path.isdir(overlap_dir)
         overlap_dirs.append(overlap_dir)
-    builder = TracerConnectivityBuilder(overlap_dirs, injection_site_roi_mapper=case_sheet['injection_site_coarse'].to_dict())
-    connectivities = [tracer_connectivity for tracer_connectivity in builder.tracer_connectivities if tracer_connectivity.anterograde==is_anterograde]
-    return connectivities
+    # tracer direction is read from the metalines, csv files of the other direction are never parsed
+    corpus_index = CorpusIndex(cache_dir)
+    corpus_index.update(overlap_dirs)
+    csv_filter = corpus_index.csv_filter(lambda csv_parser: csv_parser.is_anterograde() == is_anterograde)
+    builder = TracerConnectivityBuilder(overlap_dirs, injection_site_roi_mapper=case_sheet['injection_site_coarse'].to_dict(),
+                                        cache_dir=cache_dir, n_workers=n_workers, csv_filter=csv_filter)
+    return builder.tracer_connectivities
 
 
 def plot_data(analysis, data_type='fraction'):
@@ -49,14 +57,21 @@ def plot_data(analysis, data_type='fraction'):
 
 
 if __name__ == '__main__':
+    # figures of both analyses are rendered in the background by one pool,
+    # while the next ones are described
+    figure_renderer = FigureRenderer(n_workers=os.cpu_count())
+
     antero_analysis = TracerAnalysis(get_connectivities(is_anterograde=True))
     antero_analysis.set_analysis_name('mpfc-antero-analysis')
     antero_analysis.set_output_dir(os.path.join(os.getcwd(), 'plots'))
+    antero_analysis.set_figure_renderer(figure_renderer=figure_renderer)
     plot_data(antero_analysis)
 
     retro_analysis = TracerAnalysis(get_connectivities(is_anterograde=False))
     retro_analysis.set_analysis_name('mpfc-antero-analysis')
     retro_analysis.set_output_dir(os.path.join(os.getcwd(), 'plots'))
+    retro_analysis.set_figure_renderer(figure_renderer=figure_renderer)
     plot_data(retro_analysis)
 
-    
+    # waits for all figures of both analyses
+    figure_renderer.close()
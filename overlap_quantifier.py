@@ -0,0 +1,137 @@
+from __future__ import print_function
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import cv2
+from atlas_registry import AtlasRegistry, AtlasLookup
+from csv_parser import RoiCsvParser
+
+
+# image at path as read by cv2, or image itself if it is already an array
+def _load_image(image):
+    if isinstance(image, np.ndarray):
+        return image
+    loaded = cv2.imread(image, -1)
+    if loaded is None:
+        raise ValueError('cannot read image {}'.format(image))
+    return loaded
+
+
+# (hemisphere, roi id) pixel counts of one section, see OverlapQuantifier.counts.
+# module level so that it can be sent to worker processes
+def _section_counts(custom_atlas, atlas_image, mask, threshold, midline_col, tile_rows):
+    atlas_image = _load_image(atlas_image)
+    mask = _load_image(mask)
+    if mask.shape != atlas_image.shape[:2]:
+        raise ValueError('tracer mask is {}, atlas image is {}'.format(mask.shape, atlas_image.shape[:2]))
+    lookup = AtlasRegistry.lookup(custom_atlas)
+    n_rois = len(lookup.rgb_indices)
+    n_rows, n_cols = mask.shape
+    if midline_col is None:
+        midline_col = n_cols // 2
+    # key of a pixel: hemisphere * n_rois + roi id, pixels of unknown colors are dropped
+    hemisphere_offsets = np.where(np.arange(n_cols) < midline_col, 0, n_rois)
+    area = np.zeros(2 * n_rois, dtype=np.int64)
+    overlap = np.zeros(2 * n_rois, dtype=np.int64)
+    roi_ids = np.empty((min(tile_rows, n_rows), n_cols), dtype=np.uint16)
+    for start in range(0, n_rows, tile_rows):
+        stop = min(start + tile_rows, n_rows)
+        tile_roi_ids = lookup.rgbatlas_to_roi_ids(atlas_image[start: stop], out=roi_ids[: stop - start])
+        known = tile_roi_ids != AtlasLookup.UNKNOWN_ID
+        keys = tile_roi_ids + hemisphere_offsets
+        area += np.bincount(keys[known], minlength=2 * n_rois)
+        overlap += np.bincount(keys[known & (mask[start: stop] > threshold)], minlength=2 * n_rois)
+    return area.reshape(2, n_rois), overlap.reshape(2, n_rois)
+
+
+class OverlapQuantifier:
+    """
+    OverlapQuantifier class:
+    quantifies the overlap of a tracer with the rois of a registered atlas
+    level, as connection lens does in its roi overlap csv files
+       atlas image: bgr image of the atlas level, as read by cv2.imread
+       tracer mask: single channel image of the same size, pixels greater than
+       threshold are tracer labelled
+    pixels before midline_col (the middle column if None) are counted in
+    hemisphere HEMISPHERES[0], the others in HEMISPHERES[1]. pixels of colors
+    that are not rois of the atlas are not counted. images are processed
+    tile_rows rows at a time
+    n_workers: if None or 1, sections are quantified in process, otherwise in a
+    pool of n_workers processes
+    """
+    HEMISPHERES = ('l', 'r')
+
+    def __init__(self, custom_atlas='ARA', threshold=0, midline_col=None, tile_rows=AtlasLookup.TILE_ROWS,
+                 n_workers=None):
+        self.custom_atlas = custom_atlas
+        self.lookup = AtlasRegistry.lookup(custom_atlas)
+        self.threshold = threshold
+        self.midline_col = midline_col
+        self.tile_rows = tile_rows
+        self.n_workers = n_workers
+
+    def counts(self, atlas_image, mask):
+        """
+        :param atlas_image, mask: arrays, or paths to images read by cv2.imread
+        :return: int64 arrays area, overlap of shape (hemisphere, roi id), in pixels
+        """
+        return _section_counts(self.custom_atlas, atlas_image, mask, self.threshold, self.midline_col,
+                               self.tile_rows)
+
+    def _frame(self, area, overlap):
+        hemisphere_ids, roi_ids = np.nonzero(area)
+        rgb_indices = self.lookup.rgb_indices.take(roi_ids)
+        df = pd.DataFrame({
+            'rgb_index': rgb_indices,
+            'hemisphere': np.array(OverlapQuantifier.HEMISPHERES, dtype=object).take(hemisphere_ids),
+            'atlas_only': (area - overlap)[hemisphere_ids, roi_ids].astype(np.float64),
+            'overlap': overlap[hemisphere_ids, roi_ids].astype(np.float64),
+            'region': self.lookup.roi_names.take(roi_ids)
+        })
+        df['area'] = df['atlas_only'] + df['overlap']
+        return df
+
+    def quantify(self, atlas_image, mask):
+        """
+        :return: data frame of the rois present in the section, by hemisphere
+                 then rgb index, with the columns of LevelConnectivity.df and region
+        """
+        return self._frame(*self.counts(atlas_image, mask))
+
+    def quantify_sections(self, sections):
+        """
+        :param sections: list of (atlas_image, mask) pairs, arrays or image paths.
+                         paths avoid sending images to worker processes
+        :return: list of data frames, see quantify, in the order of sections
+        """
+        args = [(self.custom_atlas, atlas_image, mask, self.threshold, self.midline_col, self.tile_rows)
+                for atlas_image, mask in sections]
+        if self.n_workers is None or self.n_workers <= 1:
+            section_counts = [_section_counts(*section_args) for section_args in args]
+        else:
+            with ProcessPoolExecutor(max_workers=self.n_workers) as executor:
+                futures = [executor.submit(_section_counts, *section_args) for section_args in args]
+                section_counts = [future.result() for future in futures]
+        return [self._frame(area, overlap) for area, overlap in section_counts]
+
+    def write_csv(self, csv_path, df, meta_info):
+        """
+        write df, see quantify, in the connection lens roi overlap csv layout,
+        so that it can be read by LevelConnectivity
+        :param meta_info: metaline values, keys as CsvParser.init_meta_info.
+                          Atlas Name and Overlap Format are set by the quantifier
+        """
+        meta_info = dict(meta_info)
+        meta_info['Atlas Name'] = self.custom_atlas
+        meta_info['Overlap Format'] = 'Region'
+        metalines = ['{}: {}'.format(key, value) for key, value in meta_info.items() if value is not None]
+        rgb_indices = df['rgb_index'].values.astype(np.int64)
+        r, g, b = rgb_indices >> 16, rgb_indices >> 8 & 255, rgb_indices & 255
+        with open(csv_path, 'w') as f:
+            f.write('Metalines: {}\n'.format(len(metalines)))
+            for metaline in metalines:
+                f.write(metaline + '\n')
+            f.write('{}, ATLAS ONLY, OVERLAP, REGION\n'.format(RoiCsvParser.METALINE_END_TOKEN))
+            for row in zip(df['hemisphere'].values, r, g, b, df['atlas_only'].values, df['overlap'].values,
+                           df['region'].values):
+                f.write('({}:{}:{}:{}), {:.0f}, {:.0f}, {}\n'.format(*row))
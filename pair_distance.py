@@ -0,0 +1,80 @@
+from __future__ import division
+import numpy as np
+from numpy import linalg
+from scipy.cluster.hierarchy import linkage
+
+
+class PairDistance:
+    """
+    PairDistance class:
+    cosine and modified cosine distances between the rows of a matrix, as
+    condensed distance vectors in the layout of scipy.spatial.distance.pdist
+       cosine: 1 - v0 . v1 / (|v0| |v1| + epsilon)
+       modified_cosine: cosine * max(sum(v0), sum(v1)) / (min(sum(v0), sum(v1)) + epsilon)
+    dot products come from matrix products over blocks of rows. a block holds
+    at most BLOCK_ELEMENTS pairs, which bounds memory use for large matrices
+    """
+    EPSILON = 1e-6
+    DISTANCE_TYPES = ['cosine', 'modified_cosine']
+    BLOCK_ELEMENTS = 1 << 22
+
+    @staticmethod
+    def pair(v0, v1, distance_type='cosine'):
+        """ distance between two vectors, the reference definition of condensed() """
+        epsilon = PairDistance.EPSILON
+        cosine_d = 1 - np.dot(v0, v1) / (linalg.norm(v0, 2) * linalg.norm(v1, 2) + epsilon)
+        if distance_type == 'cosine':
+            return cosine_d
+        r_d = max(np.sum(v0), np.sum(v1)) / (min(np.sum(v0), np.sum(v1)) + epsilon)
+        return cosine_d * r_d
+
+    @staticmethod
+    def condensed(x, distance_type='cosine', block_elements=None):
+        """
+        :param x: 2d array like, distances are computed between its rows
+        :param distance_type: 'cosine' or 'modified_cosine'
+        :param block_elements: max number of pairs per block, defaults to PairDistance.BLOCK_ELEMENTS
+        :return: condensed distance vector of length n * (n - 1) / 2
+        """
+        if distance_type not in PairDistance.DISTANCE_TYPES:
+            raise ValueError('distance_type {} not understood'.format(distance_type))
+        x = np.asarray(x, dtype=np.float64)
+        if x.ndim != 2:
+            raise ValueError('expecting a 2d array')
+        if block_elements is None:
+            block_elements = PairDistance.BLOCK_ELEMENTS
+        n = x.shape[0]
+        epsilon = PairDistance.EPSILON
+        norms = np.sqrt(np.einsum('ij,ij->i', x, x))
+        sums = x.sum(axis=1)
+        distances = np.empty(n * (n - 1) // 2)
+        block_rows = max(1, block_elements // max(n, 1))
+        offset = 0
+        for start in range(0, n - 1, block_rows):
+            stop = min(start + block_rows, n - 1)
+            # pairs (i, j) with start <= i < stop and j > i, row major as in pdist
+            rows = np.arange(start, stop)[:, np.newaxis]
+            cols = np.arange(start, n)[np.newaxis, :]
+            upper = cols > rows
+            dots = x[start:stop].dot(x[start:].T)
+            cosine_d = 1 - dots / (norms[start:stop, np.newaxis] * norms[np.newaxis, start:] + epsilon)
+            if distance_type == 'modified_cosine':
+                sums0, sums1 = sums[start:stop, np.newaxis], sums[np.newaxis, start:]
+                cosine_d *= np.maximum(sums0, sums1) / (np.minimum(sums0, sums1) + epsilon)
+            block = cosine_d[upper]
+            distances[offset: offset + len(block)] = block
+            offset += len(block)
+        return distances
+
+    @staticmethod
+    def complete_linkage(x, distance_type='cosine'):
+        """
+        complete linkage of the rows of x, as clustered by cluster_2d. negative
+        and nan distances are treated as 0
+        :return: linkage matrix in the layout of scipy.cluster.hierarchy.linkage
+        """
+        distance_vec = PairDistance.condensed(x, distance_type)
+        distance_vec = np.clip(distance_vec, a_min=0, a_max=np.iinfo('i').max)
+        distance_vec[np.isnan(distance_vec)] = 0
+        z = linkage(distance_vec, method='complete')
+        return np.clip(z, a_min=0, a_max=np.inf)
@@ -1,10 +1,14 @@
 import os
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 import seaborn as sns
 from matplotlib import pyplot as plt
-from scipy.spatial.distance import pdist
+from scipy import sparse
 from scipy.cluster.hierarchy import linkage
+from pair_distance import PairDistance
+from roi_aggregation import RoiAggregation
+from tracer_analysis import TracerAnalysis
 
 def compute_pr(df_projection, df_input):
     # Drop the 'Case ID' and the last column which seems to contain NaN values
@@ -30,14 +34,166 @@ def compute_pr(df_projection, df_input):
     
     return df_pr
 
-def _mod_cos_pair_distance(v0, v1):
-        """ modified cosine for fractions, cosine for densities """
-        epsilon = 1e-6
-        cosine_d = 1 - np.dot(v0, v1) / \
-                       (np.linalg.norm(v0, 2) * np.linalg.norm(v1, 2) + epsilon)
-        r_d = max(np.sum(v0), np.sum(v1)) / (min(np.sum(v0), np.sum(v1)) + epsilon)
-        return cosine_d * r_d
-    
+
+# projection reciprocity of elementwise anterograde and retrograde values, as compute_pr
+def _pr(antero, retro):
+    max_values = np.maximum(antero, retro)
+    max_values[max_values == 0] = np.finfo(float).eps
+    return np.minimum(antero, retro) / max_values * ((antero + retro) / 2)
+
+
+# percentile interval of pr over bootstrap replicates, for a block of columns.
+# module level so that it can be sent to worker processes. weights are
+# (replicate * site, case) and counts (case, column) for each direction
+def _pr_interval(antero_weights, antero_counts, antero_totals, retro_weights, retro_counts, retro_totals,
+                 n_replicates, percentiles):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        antero = antero_weights.dot(antero_counts) / antero_weights.dot(antero_totals)[:, np.newaxis]
+        retro = retro_weights.dot(retro_counts) / retro_weights.dot(retro_totals)[:, np.newaxis]
+    pr = _pr(antero, retro).reshape(n_replicates, -1, antero_counts.shape[1])
+    return np.percentile(pr, percentiles, axis=0)
+
+
+class ReciprocityEngine:
+    """
+    ReciprocityEngine class:
+    projection reciprocity of an anterograde and a retrograde TracerAnalysis,
+    computed from their cubes in memory rather than from exported csv files
+       pr = min(a, r) / max(a, r) * (a + r) / 2, max(a, r) of 0 replaced by float eps as in compute_pr
+    rows are the injection sites of both analyses, case tracers merged by
+    injection site as select_data(case_aggregate_rule='injection_site'), and
+    aligned by integer position. the rois of all selections are aggregated by a
+    single sparse matmul per analysis, and pr of all of them by a single array
+    expression
+    data_type: 'fraction' or 'density'
+    bootstrap() estimates percentile intervals of fraction pr from case level
+    bootstrap replicates: the case tracers of each injection site are drawn with
+    replacement, in both analyses. the fraction of a site in a replicate is the
+    summed count of its drawn cases over their summed total count, so all
+    replicates of a block of columns are a single matmul of replicate weights
+    and case counts. blocks hold at most BLOCK_ELEMENTS values per direction
+    """
+    BLOCK_ELEMENTS = 1 << 22
+
+    def __init__(self, antero_analysis, retro_analysis, data_type='fraction'):
+        if not antero_analysis.anterograde or retro_analysis.anterograde:
+            raise ValueError('expecting an anterograde and a retrograde analysis')
+        if not np.array_equal(antero_analysis.cube.roi_names, retro_analysis.cube.roi_names):
+            raise ValueError('analyses with different rois')
+        self.data_type = data_type
+        antero_cube, retro_cube = antero_analysis.cube, retro_analysis.cube
+        # injection sites are sorted and unique
+        self.injection_sites = np.intersect1d(antero_cube.injection_sites, retro_cube.injection_sites)
+        # case level cubes of the shared injection sites, and the site of each case
+        self.antero_cases, self.antero_sites = ReciprocityEngine._shared_sites(antero_cube, self.injection_sites)
+        self.retro_cases, self.retro_sites = ReciprocityEngine._shared_sites(retro_cube, self.injection_sites)
+        site_labels = {'injection_site': self.injection_sites}
+        self.antero_cube = self.antero_cases.group_rows(self.antero_sites, site_labels)
+        self.retro_cube = self.retro_cases.group_rows(self.retro_sites, site_labels)
+
+    @staticmethod
+    def _shared_sites(cube, injection_sites):
+        row_ids = np.flatnonzero(np.isin(cube.row_labels['injection_site'], injection_sites))
+        cases = cube.take_rows(row_ids)
+        return cases, np.searchsorted(injection_sites, cases.row_labels['injection_site'])
+
+    # stacked roi aggregation matrix of all selections, the coarse roi names,
+    # the bounds of each selection's rois and whether its columns are sorted
+    def _selection_matrix(self, selections):
+        matrices, roi_names, bounds, sort_columns = [], [], [0], []
+        for roi_group_names, roi_aggregate_rule in selections.values():
+            if isinstance(roi_group_names, str):
+                roi_group_names = [roi_group_names]
+            selected_roi_names = TracerAnalysis.selected_roi_names(roi_group_names=roi_group_names)
+            # as in select_data, columns are only sorted if rois are selected or aggregated
+            sort_columns.append(selected_roi_names is not None or roi_aggregate_rule is not None)
+            if sort_columns[-1]:
+                matrix, selection_roi_names = RoiAggregation.compile(self.antero_cube.roi_names, selected_roi_names,
+                                                                     roi_aggregate_rule)
+            else:
+                matrix = sparse.identity(len(self.antero_cube.roi_names), format='csr')
+                selection_roi_names = list(self.antero_cube.roi_names)
+            matrices.append(matrix)
+            roi_names.extend(selection_roi_names)
+            bounds.append(len(roi_names))
+        return sparse.hstack(matrices).tocsr(), roi_names, bounds, sort_columns
+
+    # split values of shape (site, coarse roi, hemisphere) into a data frame per selection
+    def _frames(self, values, selections, roi_names, bounds, sort_columns):
+        hemispheres = self.antero_cube.hemispheres
+        index = pd.Index(self.injection_sites, name='injection_site')
+        frames = {}
+        for name, start, stop, sort in zip(selections, bounds[:-1], bounds[1:], sort_columns):
+            columns = np.array(['{}_{}'.format(roi_name, hemisphere) for roi_name in roi_names[start: stop]
+                                for hemisphere in hemispheres], dtype=object)
+            column_ids = np.argsort(columns, kind='stable') if sort else np.arange(len(columns))
+            frame_values = values[:, start: stop].reshape(len(index), -1)[:, column_ids]
+            frames[name] = pd.DataFrame(frame_values, index=index,
+                                        columns=pd.Index(columns[column_ids], name='roi_name'))
+        return frames
+
+    def compute(self, selections):
+        """
+        :param selections: dict name: (roi_group_names, roi_aggregate_rule), as
+                           passed to select_data. either may be None
+        :return: dict name: pr data frame, index injection_site, columns
+                 hemisphere roi names ordered as in selected data
+        """
+        matrix, roi_names, bounds, sort_columns = self._selection_matrix(selections)
+        antero = self.antero_cube.aggregate_rois(matrix, roi_names).values(self.data_type)
+        retro = self.retro_cube.aggregate_rois(matrix, roi_names).values(self.data_type)
+        return self._frames(_pr(antero, retro), selections, roi_names, bounds, sort_columns)
+
+    # (replicate * site, case) weights of case level bootstrap replicates. a
+    # case's weight is the number of times it is drawn for its site
+    def _replicate_weights(self, sites, n_replicates, rng):
+        n_sites = len(self.injection_sites)
+        weights = np.zeros((n_replicates, n_sites, len(sites)))
+        for site in range(n_sites):
+            cases = np.flatnonzero(sites == site)
+            weights[:, site, cases] = rng.multinomial(len(cases), np.full(len(cases), 1. / len(cases)),
+                                                      size=n_replicates)
+        return weights.reshape(n_replicates * n_sites, len(sites))
+
+    def bootstrap(self, selections, n_replicates=1000, confidence=0.95, seed=0, n_workers=None):
+        """
+        percentile intervals of fraction pr over case level bootstrap replicates
+        :param selections: see compute
+        :param confidence: the interval holds the central confidence share of the replicates
+        :param seed: replicates are drawn from np.random.default_rng(seed), whatever n_workers is
+        :param n_workers: None or 1 computes blocks of columns in process, otherwise in a pool of n_workers processes
+        :return: dict name: (lower, upper) data frames, laid out as compute's
+        """
+        if self.data_type != 'fraction':
+            raise ValueError('bootstrap intervals are only available for fraction')
+        matrix, roi_names, bounds, sort_columns = self._selection_matrix(selections)
+        rng = np.random.default_rng(seed)
+        antero_weights = self._replicate_weights(self.antero_sites, n_replicates, rng)
+        retro_weights = self._replicate_weights(self.retro_sites, n_replicates, rng)
+        # (case, coarse roi * hemisphere) counts, and the case totals over all rois
+        antero_counts = self.antero_cases.aggregate_rois(matrix, roi_names).count.reshape(len(self.antero_sites), -1)
+        retro_counts = self.retro_cases.aggregate_rois(matrix, roi_names).count.reshape(len(self.retro_sites), -1)
+        antero_totals = self.antero_cases.count.sum(axis=(1, 2))
+        retro_totals = self.retro_cases.count.sum(axis=(1, 2))
+
+        percentiles = [50. * (1 - confidence), 50. * (1 + confidence)]
+        n_columns = antero_counts.shape[1]
+        block_columns = max(1, ReciprocityEngine.BLOCK_ELEMENTS // len(antero_weights))
+        blocks = [slice(start, min(start + block_columns, n_columns)) for start in range(0, n_columns, block_columns)]
+        args = [(antero_weights, antero_counts[:, block], antero_totals, retro_weights, retro_counts[:, block],
+                 retro_totals, n_replicates, percentiles) for block in blocks]
+        if n_workers is None or n_workers <= 1:
+            intervals = [_pr_interval(*block_args) for block_args in args]
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                intervals = list(executor.map(_pr_interval, *zip(*args)))
+        # (percentile, site, coarse roi, hemisphere)
+        intervals = np.concatenate(intervals, axis=2).reshape((2, len(self.injection_sites), len(roi_names), -1))
+        lower = self._frames(intervals[0], selections, roi_names, bounds, sort_columns)
+        upper = self._frames(intervals[1], selections, roi_names, bounds, sort_columns)
+        return {name: (lower[name], upper[name]) for name in selections}
+
+
 def cluster_2d(selected_matrix_df, roi_lbls, inj_site_lbls, title=None, 
                out_dir=None, fmt=None):
     if not isinstance(selected_matrix_df, pd.DataFrame):
@@ -53,7 +209,7 @@ def cluster_2d(selected_matrix_df, roi_lbls, inj_site_lbls, title=None,
         raise ValueError('matrix column number and roi labels length inconsistent')
 
     # distances between inj sites and regions  
-    inj_site_distance_vec = pdist(selected_matrix, _mod_cos_pair_distance)
+    inj_site_distance_vec = PairDistance.condensed(selected_matrix, 'modified_cosine')
     inj_site_distance_vec = np.clip(inj_site_distance_vec,
                                 a_min=0, a_max=np.iinfo('i').max)
     inj_site_distance_vec[np.isnan(inj_site_distance_vec)] = 0
@@ -61,7 +217,7 @@ def cluster_2d(selected_matrix_df, roi_lbls, inj_site_lbls, title=None,
     Z_injections = np.clip(Z_injections, a_min=0, a_max=np.inf)
 
     D = np.transpose(selected_matrix)
-    region_distance_vec = pdist(D, _mod_cos_pair_distance)
+    region_distance_vec = PairDistance.condensed(D, 'modified_cosine')
     region_distance_vec = np.clip(region_distance_vec,
                                     a_min=0, a_max=np.iinfo('i').max)
     region_distance_vec[np.isnan(region_distance_vec)] = 0
@@ -0,0 +1,67 @@
+import numpy as np
+from scipy import sparse
+from roi_groups import ROI_MAPPINGS
+
+
+class RoiAggregation:
+    """
+    RoiAggregation class:
+    roi selection and roi aggregation compiled into a sparse (fine roi, coarse
+    roi) matrix of 0s and 1s. fine rois are the roi axis of a ConnectivityCube,
+    coarse rois are the selected rois, or the destination names of the aggregate
+    rule. selected rois absent from the aggregate rule are dropped. summing
+    fine rois into coarse rois is a single sparse matmul (see
+    ConnectivityCube.aggregate_rois)
+    compiled matrices are cached process wide, keyed by the fine roi names,
+    the selected roi names and the aggregate rule. aggregate rules named in
+    roi_groups.ROI_MAPPINGS are keyed by name, dict rules by their items
+    """
+    _compiled = {}
+
+    @staticmethod
+    def _rule_key(roi_aggregate_rule):
+        if roi_aggregate_rule is None or isinstance(roi_aggregate_rule, str):
+            return roi_aggregate_rule
+        return frozenset(roi_aggregate_rule.items())
+
+    @classmethod
+    def compile(cls, fine_roi_names, selected_roi_names=None, roi_aggregate_rule=None):
+        """
+        :param fine_roi_names: roi names of the roi axis to aggregate
+        :param selected_roi_names: roi names to keep, None keeps all fine rois
+        :param roi_aggregate_rule: None, name in ROI_MAPPINGS, or dict roi name: destination roi name
+        :return: (csr matrix of shape (fine roi, coarse roi), coarse roi names sorted ascending)
+        """
+        fine_roi_names = tuple(fine_roi_names)
+        if selected_roi_names is not None:
+            selected_roi_names = tuple(sorted(set(selected_roi_names)))
+        key = (fine_roi_names, selected_roi_names, cls._rule_key(roi_aggregate_rule))
+        if key not in cls._compiled:
+            cls._compiled[key] = cls._build(fine_roi_names, selected_roi_names, roi_aggregate_rule)
+        return cls._compiled[key]
+
+    @staticmethod
+    def _build(fine_roi_names, selected_roi_names, roi_aggregate_rule):
+        fine_roi_ids = {roi_name: roi_id for roi_id, roi_name in enumerate(fine_roi_names)}
+        if selected_roi_names is None:
+            selected_roi_names = fine_roi_names
+        else:
+            missing_roi_names = [roi_name for roi_name in selected_roi_names if roi_name not in fine_roi_ids]
+            if missing_roi_names:
+                raise KeyError('rois not in data: {}'.format(missing_roi_names))
+        if isinstance(roi_aggregate_rule, str):
+            roi_aggregate_rule = ROI_MAPPINGS[roi_aggregate_rule]
+        if roi_aggregate_rule is None:
+            roi_aggregate_rule = {roi_name: roi_name for roi_name in selected_roi_names}
+        selected_roi_names = [roi_name for roi_name in selected_roi_names if roi_name in roi_aggregate_rule]
+        coarse_roi_names, coarse_roi_ids = np.unique(np.array([roi_aggregate_rule[roi_name]
+                                                               for roi_name in selected_roi_names], dtype=object),
+                                                     return_inverse=True)
+        rows = np.array([fine_roi_ids[roi_name] for roi_name in selected_roi_names], dtype=np.int64)
+        matrix = sparse.csr_matrix((np.ones(len(rows)), (rows, coarse_roi_ids)),
+                                   shape=(len(fine_roi_names), len(coarse_roi_names)))
+        return matrix, coarse_roi_names
+
+    @classmethod
+    def clear(cls):
+        cls._compiled.clear()
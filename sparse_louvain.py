@@ -0,0 +1,193 @@
+from __future__ import division
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy import sparse
+
+ConsensusResult = namedtuple('ConsensusResult', ['partition', 'stability', 'co_assignment'])
+
+
+class SparseLouvain:
+    """
+    SparseLouvain class:
+    louvain community detection on a weighted undirected graph given as a
+    symmetric scipy.sparse adjacency matrix. nodes are matrix positions, labels
+    are left to the caller. follows python-louvain's best_partition: a node is
+    moved to the neighbor community with the largest modularity gain if that
+    gain is strictly larger than the gain of staying in its own community,
+    until a pass improves modularity by less than MIN_IMPROVEMENT, then the
+    communities are merged into the nodes of the next level. local moves visit
+    one node at a time, only the modularity and the merges are vectorized
+       modularity: sum over communities c of in_c / m2 - resolution * (tot_c / m2) ** 2
+       in_c: sum of adjacency entries within c, tot_c: sum of degrees in c, m2: sum of all entries
+    the merge of a level is a sparse matrix product. nodes are visited in a
+    random order drawn from seed, as python-louvain's random_state
+    """
+    MIN_IMPROVEMENT = 1e-7
+
+    def __init__(self, resolution=1., seed=None):
+        self.resolution = resolution
+        self.seed = seed
+
+    @staticmethod
+    def modularity(adjacency, communities, resolution=1.):
+        """
+        :param communities: int array, community of each node in range(n_communities)
+        """
+        adjacency = sparse.coo_matrix(adjacency)
+        communities = np.asarray(communities, dtype=np.int64)
+        m2 = adjacency.sum()
+        if m2 == 0:
+            return 0.
+        n_communities = communities.max() + 1
+        degrees = np.bincount(adjacency.row, weights=adjacency.data, minlength=adjacency.shape[0])
+        within = communities[adjacency.row] == communities[adjacency.col]
+        internal = np.bincount(communities[adjacency.row[within]], weights=adjacency.data[within],
+                               minlength=n_communities)
+        totals = np.bincount(communities, weights=degrees, minlength=n_communities)
+        return np.sum(internal / m2 - resolution * (totals / m2) ** 2)
+
+    # local moving of one level. returns the community of each node, renumbered to range(n_communities)
+    def _one_level(self, adjacency, rng):
+        n = adjacency.shape[0]
+        m2 = adjacency.sum()
+        degrees = np.asarray(adjacency.sum(axis=1)).ravel()
+        communities = np.arange(n)
+        totals = degrees.copy()
+        indptr, indices, data = adjacency.indptr, adjacency.indices, adjacency.data
+        modularity = SparseLouvain.modularity(adjacency, communities, self.resolution)
+        while True:
+            moved = False
+            for node in rng.permutation(n):
+                neighbors = indices[indptr[node]: indptr[node + 1]]
+                weights = data[indptr[node]: indptr[node + 1]]
+                # self loops do not count towards the links to a community
+                not_self = neighbors != node
+                neighbor_communities, positions = np.unique(communities[neighbors[not_self]], return_inverse=True)
+                community = communities[node]
+                totals[community] -= degrees[node]
+                if len(neighbor_communities) == 0:
+                    totals[community] += degrees[node]
+                    continue
+                links = np.bincount(positions, weights=weights[not_self], minlength=len(neighbor_communities))
+                gains = links - self.resolution * totals[neighbor_communities] * degrees[node] / m2
+                # gain of putting the node back in its own community, which it
+                # leaves only for a strictly larger gain
+                own = neighbor_communities == community
+                own_links = links[own].sum()
+                own_gain = own_links - self.resolution * totals[community] * degrees[node] / m2
+                best = np.argmax(gains)
+                best_community = neighbor_communities[best] if gains[best] > own_gain else community
+                totals[best_community] += degrees[node]
+                if best_community != community:
+                    communities[node] = best_community
+                    moved = True
+            new_modularity = SparseLouvain.modularity(adjacency, communities, self.resolution)
+            if not moved or new_modularity - modularity < SparseLouvain.MIN_IMPROVEMENT:
+                break
+            modularity = new_modularity
+        return np.unique(communities, return_inverse=True)[1]
+
+    # adjacency of the graph whose nodes are the communities of adjacency
+    @staticmethod
+    def _aggregate(adjacency, communities):
+        n = adjacency.shape[0]
+        membership = sparse.csr_matrix((np.ones(n), (np.arange(n), communities)),
+                                       shape=(n, communities.max() + 1))
+        return (membership.T.dot(adjacency).dot(membership)).tocsr()
+
+    def best_partition(self, adjacency):
+        """
+        :param adjacency: symmetric scipy.sparse matrix with non negative weights
+        :return: int array, community of each node in range(n_communities)
+        """
+        adjacency = sparse.csr_matrix(adjacency, dtype=np.float64)
+        if (adjacency != adjacency.T).nnz > 0:
+            raise ValueError('adjacency matrix should be symmetric')
+        rng = np.random.default_rng(self.seed)
+        partition = np.arange(adjacency.shape[0])
+        if adjacency.sum() == 0:
+            return partition
+        modularity = SparseLouvain.modularity(adjacency, partition, self.resolution)
+        while True:
+            communities = self._one_level(adjacency, rng)
+            partition = communities[partition]
+            new_modularity = SparseLouvain.modularity(adjacency, communities, self.resolution)
+            if new_modularity - modularity < SparseLouvain.MIN_IMPROVEMENT:
+                break
+            modularity = new_modularity
+            adjacency = SparseLouvain._aggregate(adjacency, communities)
+        return partition
+
+
+# louvain partitions of adjacency, one per seed. module level so that it can be
+# sent to worker processes. returns the summed co-assignment counts and the
+# number of runs each node was alone in its community
+def _co_assignment_counts(adjacency, resolution, seeds):
+    n = adjacency.shape[0]
+    co_assigned = np.zeros((n, n), dtype=np.int64)
+    alone = np.zeros(n, dtype=np.int64)
+    for seed in seeds:
+        communities = SparseLouvain(resolution=resolution, seed=seed).best_partition(adjacency)
+        co_assigned += communities[:, np.newaxis] == communities[np.newaxis, :]
+        alone += np.bincount(communities)[communities] == 1
+    return co_assigned, alone
+
+
+class ConsensusLouvain:
+    """
+    ConsensusLouvain class:
+    consensus of n_runs SparseLouvain partitions of a graph. run i is seeded
+    with the i-th child of np.random.SeedSequence(seed), so results are
+    deterministic given seed, whatever n_workers is
+    results:
+       co_assignment: float array (node, node), fraction of runs in which both
+       nodes are in the same community
+       partition: int array, community of each node in the louvain partition
+       of the co-assignment graph, whose edges are the co_assignment entries of
+       at least threshold between distinct nodes
+       stability: float array, mean co_assignment of each node with the other
+       nodes of its consensus community. for a node alone in its consensus
+       community, the fraction of runs it was alone in
+    n_workers: if None or 1, partitions are computed in process, otherwise in a
+    pool of n_workers processes
+    """
+    def __init__(self, n_runs=100, seed=0, resolution=1., threshold=0.5, n_workers=None):
+        self.n_runs = n_runs
+        self.seed = seed
+        self.resolution = resolution
+        self.threshold = threshold
+        self.n_workers = n_workers
+
+    def run(self, adjacency):
+        """
+        :param adjacency: symmetric scipy.sparse matrix with non negative weights
+        :return: ConsensusResult
+        """
+        adjacency = sparse.csr_matrix(adjacency, dtype=np.float64)
+        sequences = np.random.SeedSequence(self.seed).spawn(self.n_runs + 1)
+        seeds, consensus_seed = sequences[:-1], sequences[-1]
+        if self.n_workers is None or self.n_workers <= 1:
+            co_assigned, alone = _co_assignment_counts(adjacency, self.resolution, seeds)
+        else:
+            batches = np.array_split(np.arange(self.n_runs), min(self.n_runs, 4 * self.n_workers))
+            co_assigned = np.zeros(adjacency.shape, dtype=np.int64)
+            alone = np.zeros(adjacency.shape[0], dtype=np.int64)
+            with ProcessPoolExecutor(max_workers=self.n_workers) as executor:
+                futures = [executor.submit(_co_assignment_counts, adjacency, self.resolution,
+                                           [seeds[i] for i in batch]) for batch in batches if len(batch) > 0]
+                # summed in submission order
+                for future in futures:
+                    batch_co_assigned, batch_alone = future.result()
+                    co_assigned += batch_co_assigned
+                    alone += batch_alone
+        co_assignment = co_assigned / self.n_runs
+        consensus_graph = np.where(co_assignment >= self.threshold, co_assignment, 0.)
+        np.fill_diagonal(consensus_graph, 0.)
+        partition = SparseLouvain(seed=consensus_seed).best_partition(sparse.csr_matrix(consensus_graph))
+        same = partition[:, np.newaxis] == partition[np.newaxis, :]
+        np.fill_diagonal(same, False)
+        n_others = same.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            stability = np.where(n_others > 0, (co_assignment * same).sum(axis=1) / n_others, alone / self.n_runs)
+        return ConsensusResult(partition, stability, co_assignment)
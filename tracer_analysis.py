@@ -3,26 +3,31 @@ import os
 import sys
 import time
 import inspect
-from copy import deepcopy
-from collections import namedtuple, defaultdict
+from collections import namedtuple, defaultdict, OrderedDict
 import math
 import numpy as np
-from numpy import linalg
 import networkx as nx
-import community as community_louvain
 from matplotlib import cm
 import matplotlib.pyplot as plt
 from matplotlib import rcParams
 from matplotlib.patches import Patch
-from scipy.spatial.distance import pdist
-from scipy.cluster.hierarchy import linkage
 import seaborn as sns
 import pandas as pd
+from scipy import sparse
 from roi_groups import ROI_GROUPS, ROI_MAPPINGS
 from custom_atlas_config import CustomAtlasConfig
 from tracer_connectivity import TracerConnectivity
+from connectivity_cube import ConnectivityCube, CubeFrames
+from roi_aggregation import RoiAggregation
+from pair_distance import PairDistance
+from cluster_stability import ClusterStability
+from sparse_louvain import SparseLouvain, ConsensusLouvain, ConsensusResult
+from figure_renderer import FigureRenderer
 rcParams.update({'figure.autolayout': True})
 
+SelectionParameters = namedtuple('SelectionParameters', ['hemispheres', 'roi_names', 'roi_group_names',
+                                                         'roi_aggregate_rule', 'case_aggregate_rule'])
+
 
 class TracerAnalysis:
     """
@@ -49,27 +54,51 @@ class TracerAnalysis:
     self.roi_exclusion_subset:
     not implemented
 
+    self.cube:
+    ConnectivityCube with one row per TracerConnectivity instance. whenever
+    self.ara_level_subset is set, self.cube is rebuilt by self.build_data().
+    self.add_tracer_connectivities and self.remove_case append and drop rows
+    of the cases concerned only, the other rows are not rebuilt
+
     self.data:
-    dict with keys count', 'area', 'fraction' and density'.
-    values are dataframes with MultiIndex (injection_site, case_tracer) and
-    roi names as columns. the dataframes are constructed from TracerConnectivity
-    instances. whenever self.ara_level_subset is set, self.data is rebuilt by
-    self.build_data()
+    dict like view of self.cube with keys count', 'area', 'fraction' and
+    density'. values are dataframes with MultiIndex (injection_site, case_tracer)
+    and roi names as columns, built from self.cube on first access
 
     self.selection_parameters
     set by self.set_selection_parameters as named tuple
     the fields in self.selection_parameters defines how to apply selection and
     grouping on self.data to generate self.selected data
 
+    self.selected_cube
+    ConnectivityCube of self.cube with self.selection_parameters applied
+
     self.selected_data
-    dict with keys count', 'area', 'fraction' and density'.
-    values are dataframes in self.data with self.selection_parameters applied
+    dict like view of self.selected_cube with keys count', 'area', 'fraction'
+    and density'. dataframes are built on first access. selections without
+    roi selection or aggregation share memory with self.cube, so their
+    dataframes are read only. steps that modify selected data, such as
+    append_total_columns, assign new dataframes instead
+
+    the selected cubes of the last TracerAnalysis.SELECTION_CACHE_SIZE distinct
+    selections are kept, keyed by selection parameters and ara_level_subset, and
+    reused by select_data. cubes are read only, so a cached cube is shared
+    rather than copied. the cache is emptied whenever self.data is rebuilt
 
     outputs are generated to self.output_dir with an autogenerated name
     including a time stamp for disambiguity. the attributes of the instance
     that are relevant to the output is written to a meta info txt file with
     matching name.
+
+    self.figure_renderer
+    FigureRenderer that renders and saves the figures described by the plot
+    methods. renders in process by default. set_figure_renderer(n_workers)
+    renders figures concurrently in a pool of headless processes, in which case
+    self.wait_figures() should be called before using the image files, and
+    self.figure_renderer.close() once no more figures are requested
     """
+    SELECTION_CACHE_SIZE = 32
+
     def __init__(self, tracer_connectivities, description=None):
         # analysis is initialized from a list of TracerConnectivity objects
         self.tracer_connectivities = tracer_connectivities
@@ -80,6 +109,11 @@ class TracerAnalysis:
 
         self.analysis_name = 'None'
         self.output_dir = os.getcwd()
+        self.figure_renderer = FigureRenderer()
+        self._owns_figure_renderer = True
+        # output names are numbered in the order outputs are requested
+        self._time_stamp = TracerAnalysis.time_stamp()
+        self._output_count = 0
 
         self.ara_level_subset = None
         # placeholder
@@ -87,15 +121,20 @@ class TracerAnalysis:
 
         self.custom_atlas_config = CustomAtlasConfig(custom_atlas=self.custom_atlas)
 
-        self.data = {}
+        self.cube = None
+        self.data = CubeFrames()
         self._max_density = None
+        # selection key: selected cube, least recently used first
+        self._selection_cache = OrderedDict()
         self.multi_index = self.get_indices()
         self.build_data()
 
-        self.selected_data = {}
+        self.selected_cube = None
+        self.selected_data = CubeFrames()
         self.selection_parameters = None
 
         self.color_map = {}
+        self.color_map_by = None
         self.set_cmap('injection_site')
         self.distance_type = None
 
@@ -158,101 +197,128 @@ class TracerAnalysis:
                         name='injection_site:case_tracer')
 
     def build_data(self):
-        tracer_count_dfs = []
-        tracer_area_dfs = []
-        for tracer_connectivity in self.tracer_connectivities:
-            tracer_df = tracer_connectivity.tracer_connectivity
-            tracer_count_dfs.append(tracer_df.loc[:, ['overlap']].transpose())
-            tracer_area_dfs.append(tracer_df.loc[:, ['area']].transpose())
-        self.data['count'] = pd.concat(tracer_count_dfs).set_index(self.multi_index)
-        self.data['area'] = pd.concat(tracer_area_dfs).set_index(self.multi_index)
-        # divide count by row sum
-        self.data['fraction'] = self.data['count'].div(self.data['count'].sum(axis=1), axis=0)
-        self.data['density'] = self.data['fraction'] / (self.data['area'] + 1e-9)
-        self._max_density = np.max(self.data['density'].values)
-        self.data['density'] /= self._max_density
-
-    # returns hemisphere roi names
+        self._set_cube(ConnectivityCube.from_tracer_connectivities(self.tracer_connectivities))
+
+    def _set_cube(self, cube):
+        self.cube = cube
+        self.data = CubeFrames(self.cube)
+        self._max_density = self.cube.max_density
+        self._selection_cache.clear()
+
+    def add_tracer_connectivities(self, tracer_connectivities):
+        """
+        append rows for tracer_connectivities, e.g. the tracers of a newly
+        quantified case, without rebuilding the rows already in self.cube. the
+        current ara_level_subset is applied to the new instances. previous
+        selections are discarded, select_data should be called again
+        """
+        if len(tracer_connectivities) == 0:
+            return
+        for tracer_connectivity in tracer_connectivities:
+            if not isinstance(tracer_connectivity, TracerConnectivity):
+                raise TypeError("TracerConnectivity object expected, "
+                                "{} encountered".format(type(tracer_connectivity)))
+            if tracer_connectivity.custom_atlas != self.custom_atlas or \
+               tracer_connectivity.anterograde != self.anterograde or \
+               tracer_connectivity.cell_count != self.cell_count:
+                raise ValueError('inconsistent meta data fields between analysis and {} channel {}'
+                                 .format(tracer_connectivity.case_name, tracer_connectivity.channel_number))
+            if self.ara_level_subset is not None:
+                tracer_connectivity.set_ara_level_subset(ara_level_subset=self.ara_level_subset)
+        self.tracer_connectivities = self.tracer_connectivities + list(tracer_connectivities)
+        self._set_cube(self.cube.append_rows(ConnectivityCube.from_tracer_connectivities(tracer_connectivities)))
+        self._rows_changed()
+
+    def remove_case(self, case_name):
+        """
+        drop the rows of all tracers of case_name, without rebuilding the other
+        rows. previous selections are discarded, select_data should be called again
+        """
+        row_mask = np.array([tracer_connectivity.case_name == case_name
+                             for tracer_connectivity in self.tracer_connectivities])
+        if not row_mask.any():
+            raise ValueError('case {} not found'.format(case_name))
+        if row_mask.all():
+            raise ValueError('can not remove case {}, the analysis would be empty'.format(case_name))
+        self.tracer_connectivities = [tracer_connectivity for tracer_connectivity, removed
+                                      in zip(self.tracer_connectivities, row_mask) if not removed]
+        self._set_cube(self.cube.drop_rows(row_mask))
+        self._rows_changed()
+
+    # refresh the attributes derived from the rows after rows were added or removed
+    def _rows_changed(self):
+        self.multi_index = self.get_indices()
+        self.set_cmap(self.color_map_by)
+        self.selected_cube = None
+        self.selected_data.clear()
+
+    # returns sorted roi names without hemisphere suffix, None if all rois are selected
     def _selected_roi_names(self):
+        return TracerAnalysis.selected_roi_names(self.selection_parameters.roi_names,
+                                                 self.selection_parameters.roi_group_names)
+
+    # sorted roi names of roi_names or roi_group_names, as selected by select_data. None if all rois are selected
+    @staticmethod
+    def selected_roi_names(roi_names=None, roi_group_names=None):
         # if rois and roi_groups are both None, return all roi names
-        if not self.selection_parameters.roi_names and not self.selection_parameters.roi_group_names:
-            return set(self.data['count'].columns)
-        elif not self.selection_parameters.roi_group_names:
-            roi_names = self.selection_parameters.roi_names
+        if not roi_names and not roi_group_names:
+            return None
+        elif not roi_group_names:
+            roi_names = set(roi_names)
         # if roi_groups is not None, return a set of grey matter region names based on roi_groups
         else:
             roi_names = set()
-            for roi_group_name in self.selection_parameters.roi_group_names:
+            for roi_group_name in roi_group_names:
                 assert roi_group_name in ROI_GROUPS
                 roi_group = ROI_GROUPS[roi_group_name]
                 if isinstance(roi_group, set):
                     roi_names |= roi_group
                 else:
                     roi_names |= set([key for key in roi_group.keys()])
-        roi_names_hemi = set()
-        for roi_name in roi_names:
-            roi_names_hemi |= {'{}_i'.format(roi_name), '{}_c'.format(roi_name)}
-        return sorted(list(roi_names_hemi))
+        return sorted(list(roi_names))
 
     # apply roi selection and aggregation
     def _merge_rois(self):
-        if len(self.selected_data) == 0:
+        if self.selected_cube is None:
             raise ValueError('data selection should have been performed by _merge_case_tracers')
         selected_roi_names = self._selected_roi_names()
-        for data_type in ['count', 'area', 'fraction']:
-            self.selected_data[data_type] = self.selected_data[data_type].loc[:, list(selected_roi_names)]
-            # merge roi
-            if self.selection_parameters.roi_aggregate_rule is not None:
-                if isinstance(self.selection_parameters.roi_aggregate_rule, str):
-                    roi_aggregate_rule = ROI_MAPPINGS[self.selection_parameters.roi_aggregate_rule]
-                else:
-                    assert isinstance(self.selection_parameters.roi_aggregate_rule, dict)
-                    roi_aggregate_rule = self.selection_parameters.roi_aggregate_rule
-                roi_mapping = {}
-                for roi_name, mapped_roi_name in roi_aggregate_rule.items():
-                    roi_mapping['{}_i'.format(roi_name)] = '{}_i'.format(mapped_roi_name)
-                    roi_mapping['{}_c'.format(roi_name)] = '{}_c'.format(mapped_roi_name)
-                self.selected_data[data_type] = self.selected_data[data_type].groupby(by=roi_mapping, axis='columns').sum()
-        self.selected_data['density'] = self.selected_data['fraction'] / (self.selected_data['area'] + 1e-9)
-        self.selected_data['density'] /= self._max_density
-
-    # this function performs dataframe row merge based on case_aggregate_rule
+        # selection and aggregation are applied together by a cached sparse matrix.
+        # rois absent from the aggregate rule are dropped
+        if selected_roi_names is None and self.selection_parameters.roi_aggregate_rule is None:
+            return
+        matrix, roi_names = RoiAggregation.compile(self.selected_cube.roi_names, selected_roi_names,
+                                                   self.selection_parameters.roi_aggregate_rule)
+        self.selected_cube = self.selected_cube.aggregate_rois(matrix, roi_names)
+
+    # this function performs row merge based on case_aggregate_rule
     # case merging should occur before roi merging to ensure correct mle estimates
     # when pooling data from multiple rows. only allow specifying index ordering
     # under injection site merging rule
     def _merge_case_tracers(self, aggregated_index_orderings=None):
-        # no row merging occuring
+        # no row merging occuring. cubes are never modified in place
         if self.selection_parameters.case_aggregate_rule is None:
-            self.selected_data = deepcopy(self.data)
+            self.selected_cube = self.cube
         # if merging rule is known, merge accordingly
-        else:
-            if self.selection_parameters.case_aggregate_rule == 'injection_site':
-                for data_type in ['count', 'area']:
-                    self.selected_data[data_type] = self.data[data_type].groupby(level='injection_site').sum()
-                    if aggregated_index_orderings:
-                        assert set(self.selected_data[data_type].index.values) == set(aggregated_index_orderings)
-                        self.selected_data[data_type] = self.selected_data[data_type].reindex(index=aggregated_index_orderings)
-            if self.selection_parameters.case_aggregate_rule == 'combine_series':
-                for data_type in ['count', 'area']:
-                    # exchange self.multi_index with series insensitive index
-                    # make the index a column and group on it
-                    # split to multi index with levels injection_site and case_tracer
-                    self.selected_data[data_type] = \
-                        self.data[data_type].set_index(self._get_series_insensitive_indices())\
-                                            .reset_index()\
-                                            .groupby(by='injection_site:case_tracer').sum()
-                    self.selected_data[data_type].index = self.selected_data[data_type].index.str.split(pat=':', expand=True)
-                    self.selected_data[data_type].index.names = ['injection_site', 'case_tracer']
-            self.selected_data['fraction'] = self.selected_data['count'].div(self.selected_data['count'].sum(axis=1), axis=0)
-            self.selected_data['density'] = self.selected_data['fraction'] / (self.selected_data['area'] + 1e-9)
-            self.selected_data['density'] /= self._max_density
+        elif self.selection_parameters.case_aggregate_rule == 'injection_site':
+            self.selected_cube = self.cube.group_rows(self.cube.injection_site_codes,
+                                                      {'injection_site': self.cube.injection_sites})
+            if aggregated_index_orderings:
+                assert set(self.cube.injection_sites) == set(aggregated_index_orderings)
+                row_ids = np.searchsorted(self.cube.injection_sites, aggregated_index_orderings)
+                self.selected_cube = self.selected_cube.take_rows(row_ids)
+        elif self.selection_parameters.case_aggregate_rule == 'combine_series':
+            # group on series insensitive index (injection_site:case_tracer_series_insensitive)
+            # split to levels injection_site and case_tracer
+            groups, codes = np.unique(np.array(self._get_series_insensitive_indices(), dtype=object),
+                                      return_inverse=True)
+            injection_sites, case_tracers = zip(*[group.split(':') for group in groups])
+            self.selected_cube = self.cube.group_rows(codes, {'injection_site': injection_sites,
+                                                              'case_tracer': case_tracers})
 
     def _select_hemispheres(self):
         if self.selection_parameters.hemispheres == 'i+c':
             return
-        hemisphere_cols = [col for col in self.selected_data['fraction'].columns if col.endswith(self.selection_parameters.hemispheres)]
-        for data_type in ['fraction', 'density', 'count', 'area']:
-            self.selected_data[data_type] = self.selected_data[data_type].loc[:, hemisphere_cols]
+        self.selected_cube = self.selected_cube.take_hemispheres([self.selection_parameters.hemispheres])
 
     def select_data(self, hemispheres='i+c', roi_names=None, roi_group_names=None, roi_aggregate_rule=None,
                     case_aggregate_rule=None, aggregated_index_orderings=None):
@@ -275,9 +341,42 @@ class TracerAnalysis:
         """
         self.set_selection_parameters(hemispheres=hemispheres, roi_names=roi_names, roi_group_names=roi_group_names,
                                       roi_aggregate_rule=roi_aggregate_rule, case_aggregate_rule=case_aggregate_rule)
-        self._merge_case_tracers(aggregated_index_orderings=aggregated_index_orderings)
-        self._merge_rois()
-        self._select_hemispheres()
+        selection_key = self._selection_key(aggregated_index_orderings)
+        if selection_key in self._selection_cache:
+            self._selection_cache.move_to_end(selection_key)
+            self.selected_cube = self._selection_cache[selection_key]
+        else:
+            self._merge_case_tracers(aggregated_index_orderings=aggregated_index_orderings)
+            self._merge_rois()
+            self._select_hemispheres()
+            if selection_key is not None:
+                self._selection_cache[selection_key] = self.selected_cube
+                if len(self._selection_cache) > TracerAnalysis.SELECTION_CACHE_SIZE:
+                    self._selection_cache.popitem(last=False)
+        self.selected_data = CubeFrames(self.selected_cube)
+
+    def _selection_key(self, aggregated_index_orderings=None):
+        """
+        hashable form of self.selection_parameters, aggregated_index_orderings and
+        self.ara_level_subset. roi names and roi group names are order insensitive.
+        None if a parameter can not be hashed, e.g. a dict aggregate rule with list values
+        """
+        def as_set(values):
+            return None if values is None else frozenset(values)
+        roi_aggregate_rule = self.selection_parameters.roi_aggregate_rule
+        try:
+            selection_key = (self.selection_parameters.hemispheres,
+                             as_set(self.selection_parameters.roi_names),
+                             as_set(self.selection_parameters.roi_group_names),
+                             roi_aggregate_rule if not isinstance(roi_aggregate_rule, dict)
+                             else frozenset(roi_aggregate_rule.items()),
+                             self.selection_parameters.case_aggregate_rule,
+                             tuple(aggregated_index_orderings) if aggregated_index_orderings else None,
+                             as_set(self.ara_level_subset))
+            hash(selection_key)
+        except TypeError:
+            return None
+        return selection_key
 
     def filter_data(self, data_type, threshold=None, threshold_quantile=None):
         """
@@ -340,7 +439,7 @@ class TracerAnalysis:
         else:
             raise ValueError('illegal case aggregate rule')
         df = pd.melt(df, id_vars=id_vars, var_name='roi_name', value_name=data_type)
-        df = df.assign(hemisphere=df.roi_name.apply(lambda x: 'ipsilateral' if x[-1] == 'i' else 'contralateral'),
+        df = df.assign(hemisphere=np.where(df.roi_name.str[-1] == 'i', 'ipsilateral', 'contralateral'),
                        roi_name=df.roi_name.str[0:-2])
         return df
 
@@ -364,9 +463,59 @@ class TracerAnalysis:
         graph = nx.from_pandas_edgelist(df, source, target, edge_attr=[data_type])
         return graph
 
-    def community_detection(self, data_type):
-        graph = self.get_graph(data_type)
-        return community_louvain.best_partition(graph, weight=data_type)
+    def get_adjacency(self, data_type):
+        """
+        sparse adjacency of the graph of get_graph, built from the selected data
+        arrays. nodes are the unique case and roi labels of get_graph, sorted.
+        edge weights are the ipsilateral data_type values, nan is treated as 0
+        :return: (symmetric scipy.sparse.csr_matrix, array of node labels)
+        """
+        self.drop_total_columns()
+        df = self.selected_data[data_type]
+        ipsilateral = df.columns.str[-1] == 'i'
+        if not self.selection_parameters.case_aggregate_rule == 'injection_site':
+            case_labels = df.index.get_level_values('case_tracer').str.cat(
+                df.index.get_level_values('injection_site'), sep='_')
+        else:
+            case_labels = df.index.get_level_values('injection_site')
+        roi_labels = df.columns[ipsilateral].str[0:-2]
+        # cases and rois sharing a label are a single node, as in get_graph
+        node_labels, node_ids = np.unique(np.concatenate([np.asarray(case_labels, dtype=object),
+                                                          np.asarray(roi_labels, dtype=object)]).astype(str),
+                                          return_inverse=True)
+        case_ids, roi_ids = node_ids[:len(case_labels)], node_ids[len(case_labels):]
+        weights = np.nan_to_num(df.values[:, ipsilateral])
+        rows, cols = np.nonzero(weights)
+        edges = sparse.coo_matrix((weights[rows, cols], (case_ids[rows], roi_ids[cols])),
+                                  shape=(len(node_labels), len(node_labels)))
+        return (edges + edges.T).tocsr(), node_labels
+
+    def community_detection(self, data_type, resolution=1., seed=None):
+        """
+        louvain communities of the graph of get_graph, see SparseLouvain
+        :return: dict node label: community
+        """
+        adjacency, node_labels = self.get_adjacency(data_type)
+        communities = SparseLouvain(resolution=resolution, seed=seed).best_partition(adjacency)
+        return dict(zip(node_labels, communities.tolist()))
+
+    def consensus_community_detection(self, data_type, n_runs=100, seed=0, resolution=1., threshold=0.5,
+                                      n_workers=None):
+        """
+        consensus of n_runs seeded louvain partitions of the graph of get_graph,
+        see ConsensusLouvain. deterministic given seed
+        :param n_workers: None or 1 computes partitions in process, otherwise in
+                          a pool of n_workers processes
+        :return: ConsensusResult with node labels attached. partition: dict node
+                 label: community, stability: Series, co_assignment: DataFrame
+        """
+        adjacency, node_labels = self.get_adjacency(data_type)
+        result = ConsensusLouvain(n_runs=n_runs, seed=seed, resolution=resolution, threshold=threshold,
+                                  n_workers=n_workers).run(adjacency)
+        node_index = pd.Index(node_labels, name='node')
+        return ConsensusResult(dict(zip(node_labels, result.partition.tolist())),
+                               pd.Series(result.stability, index=node_index, name='stability'),
+                               pd.DataFrame(result.co_assignment, index=node_index, columns=node_index))
 
     @staticmethod
     def _heatmap_row_labels(df):
@@ -389,27 +538,6 @@ class TracerAnalysis:
             vis_ceil_val = df.values.max() * np.abs(vis_ceil_val)
         return df.clip(lower=0, upper=vis_ceil_val)
 
-    @staticmethod
-    def save_fig_maximize(figure, save_path, cg=None):
-        # retrieve the gui manager of the figure, has it maximize the gui display
-        # use a non blocking show() call, flush this gui event back to the figure.
-        # cleanup and exit display with close()
-        plot_backend = plt.get_backend()
-        mng = getattr(figure.canvas, 'manager')
-        if plot_backend == 'TkAgg':
-            mng.resize(*mng.window.maxsize())
-        elif plot_backend == 'wxAgg':
-            mng.frame.Maximize(True)
-        elif plot_backend == 'Qt4Agg':
-            mng.window.showMaximized()
-        plt.show(block=False)
-        figure.canvas.flush_events()
-        if not cg:
-            figure.savefig(save_path)
-        else:
-            cg.savefig(save_path)
-        plt.close()
-
     def plot_data_matrix(self, data_type, threshold=None, threshold_quantile=None,
                          vis_ceil_val=None, title=None):
         """
@@ -421,8 +549,6 @@ class TracerAnalysis:
         :param vis_ceil_val: if positive, clip data with upper bound as vis_ceil_val.
                              if negative, calculate upper bound as df.max() * abs(vis_ceil_val)
         :param title: title of the plot
-        :param show_fig:
-        :param save_dir:
         :return:
         """
         if len(self.selected_data) == 0:
@@ -434,6 +560,16 @@ class TracerAnalysis:
         # note: pcolor plots last row first.
         # reverse dataframe rows before plotting
         df = df.reindex(index=df.index[::-1])
+        if title is None:
+            title = data_type
+
+        output_basename = self.output_basename()
+        save_path = os.path.join(self.output_dir, '{}.png'.format(output_basename))
+        self.figure_renderer.submit(TracerAnalysis._draw_data_matrix, save_path, df, title)
+        self.write_meta_info(output_basename)
+
+    @staticmethod
+    def _draw_data_matrix(df, title):
         fig, ax = plt.subplots()
         plt.pcolormesh(df, cmap="Oranges", edgecolors='powderblue', linewidth=0.01)
 
@@ -451,62 +587,68 @@ class TracerAnalysis:
         ax.set_yticks(yticks)
         ax.set_yticklabels(row_labels)
 
-        if title is None:
-            title = data_type
         plt.title(title)
-
         plt.colorbar(fraction=0.01)
-
-        output_basename = self.output_basename()
-        save_path = os.path.join(self.output_dir, '{}.png'.format(output_basename))
-        TracerAnalysis.save_fig_maximize(plt.gcf(), save_path)
-        self.write_meta_info(output_basename)
-
-    def _pair_distance(self, v0, v1):
-        """ modified cosine for fractions, cosine for densities """
-        epsilon = 1e-6
-        cosine_d = 1 - np.dot(v0, v1) / (linalg.norm(v0, 2) * linalg.norm(v1, 2) + epsilon)
-        r_d = max(np.sum(v0), np.sum(v1)) / (min(np.sum(v0), np.sum(v1)) + epsilon)
-        if self.distance_type == 'modified_cosine':
-            return cosine_d * r_d
-        else:
-            return cosine_d
+        return fig
 
     def cluster_2d(self, data_type, threshold=None, threshold_quantile=None, vis_ceil_val=None, title=None):
         if len(self.selected_data) == 0:
             raise ValueError('no data selected')
 
+        # modified cosine for fractions, cosine for densities
         self.distance_type = 'modified_cosine' if data_type == 'fraction' else 'cosine'
         df = self.filter_data(data_type, threshold=threshold, threshold_quantile=threshold_quantile)
 
         # distances between cases and regions
-        case_distance_vec = pdist(df, self._pair_distance)
-        case_distance_vec = np.clip(case_distance_vec, a_min=0, a_max=np.iinfo('i').max)
-        case_distance_vec[np.isnan(case_distance_vec)] = 0
-        Z_injections = linkage(case_distance_vec, method='complete')
-        Z_injections = np.clip(Z_injections, a_min=0, a_max=np.inf)
+        Z_injections = PairDistance.complete_linkage(df.values, self.distance_type)
         # transpose to calculate distance between rois
-        region_distance_vec = pdist(df.transpose(), self._pair_distance)
-        region_distance_vec = np.clip(region_distance_vec, a_min=0, a_max=np.iinfo('i').max)
-        region_distance_vec[np.isnan(region_distance_vec)] = 0
-        Z_rois = linkage(region_distance_vec, method='complete')
-        Z_rois = np.clip(Z_rois, a_min=0, a_max=np.inf)
+        Z_rois = PairDistance.complete_linkage(df.values.T, self.distance_type)
 
         df = TracerAnalysis._clip_df(df, vis_ceil_val)
-        cg = sns.clustermap(df, row_linkage=Z_injections, col_linkage=Z_rois, xticklabels=True, cmap='copper', robust=False)
         if title is None:
             title = data_type
+
+        output_basename = self.output_basename()
+        save_path = os.path.join(self.output_dir, '{}.png'.format(output_basename))
+        self.figure_renderer.submit(TracerAnalysis._draw_clustermap, save_path, df, Z_injections, Z_rois, title)
+        self.write_meta_info(output_basename)
+
+    def cluster_2d_stability(self, data_type, n_clusters, threshold=None, threshold_quantile=None, n_resamples=100,
+                             seed=0, bootstrap_features=True, item_fraction=1., n_workers=None):
+        """
+        stability of the case and roi clusterings of cluster_2d, from the same
+        filtered selected data and distances. see ClusterStability for the
+        resampling and the results. no figures are rendered
+        :param n_clusters: number of clusters the co-clustering frequencies are
+                           counted for, int or a (cases, rois) tuple
+        :return: dict 'cases': StabilityResult, 'rois': StabilityResult
+        """
+        if len(self.selected_data) == 0:
+            raise ValueError('no data selected')
+        # modified cosine for fractions, cosine for densities
+        self.distance_type = 'modified_cosine' if data_type == 'fraction' else 'cosine'
+        df = self.filter_data(data_type, threshold=threshold, threshold_quantile=threshold_quantile)
+        if isinstance(n_clusters, int):
+            n_clusters = (n_clusters, n_clusters)
+        results = {}
+        for axis, axis_df, axis_n_clusters in [('cases', df, n_clusters[0]), ('rois', df.T, n_clusters[1])]:
+            results[axis] = ClusterStability(axis_df, distance_type=self.distance_type, n_clusters=axis_n_clusters,
+                                             n_resamples=n_resamples, seed=seed,
+                                             bootstrap_features=bootstrap_features, item_fraction=item_fraction,
+                                             n_workers=n_workers).run()
+        return results
+
+    @staticmethod
+    def _draw_clustermap(df, row_linkage, col_linkage, title):
+        cg = sns.clustermap(df, row_linkage=row_linkage, col_linkage=col_linkage, xticklabels=True, cmap='copper',
+                            robust=False)
         cg.fig.suptitle('2D clustermap: {}'.format(title))
         plt.setp(cg.ax_heatmap, autoscalex_on=True, rasterized=False)
         plt.setp(cg.ax_heatmap.yaxis.get_majorticklabels(), rotation=0)
         plt.setp(cg.ax_heatmap.xaxis.get_ticklabels(), rotation=90, fontsize=9)
-
-        output_basename = self.output_basename()
-        save_path = os.path.join(self.output_dir, '{}.png'.format(output_basename))
-        # save with the savefig method of the cluster grid (from seaborn documentation)
+        # saved with the savefig method of the cluster grid (from seaborn documentation)
         # this avoids incorrectly clipping figure content
-        TracerAnalysis.save_fig_maximize(cg.fig, save_path, cg=cg)
-        self.write_meta_info(output_basename)
+        return cg
 
     def plot_data_scatter(self, data_type, free_ymax=False, use_global_ymax=False, hue_order=None):
         # get tidy data
@@ -526,66 +668,55 @@ class TracerAnalysis:
             order = ['ipsilateral', 'contralateral']
         else:
             order = ['ipsilateral'] if self.selection_parameters.hemispheres == 'i' else ['contralateral']
+        tracer_preamble = 'Projection to' if self.anterograde else 'Input from'
+        # one figure per n_rows * n_cols rois, sharing the output basename
+        output_basename = self.output_basename()
         for roi_rank in range(0, n_regions, n_rows * n_cols):
-            subplot_id = 0
-            fig, axes = plt.subplots(nrows=n_rows, ncols=n_cols, sharey=False, sharex=False)
+            page_rois = list(ranked_rois[roi_rank: roi_rank + n_rows * n_cols])
             # retrieve max y value appearing in the figure
             fig_ymax = ranked_max_values[roi_rank]
-            ymax = global_ymax if use_global_ymax else fig_ymax
-            axes = axes.flatten()
-            for i, roi in enumerate(ranked_rois[roi_rank:]):
-                df_roi = df.loc[df['roi_name'] == roi]
-                axes[i].set_xlim([0, 5])
-                axes[i].set_xticks([1, 4])
-                axes[i].axvline(x=3, ymin=0, ymax=1, color='black', linestyle='dashed')
-                # for seaborn 0.9.1, if y is passed as series instead of numpy array, the legend is incorrectly generated
-                sns.stripplot(x='hemisphere', y=df_roi[data_type].values, hue='injection_site',
-                              data=df_roi, jitter=False, ax=axes[i], palette=self.color_map, dodge=True, size=7.5,
-                              order=order, hue_order=hue_order)
-                if not free_ymax:
-                    axes[i].set_ylim([0, ymax * 1.1])
-                tracer_preamble = 'Projection to' if self.anterograde else 'Input from'
-                axes[i].set_ylabel('{} {}'.format(tracer_preamble, roi), fontsize=14)
-                axes[i].set_xlabel('')
-                axes[i].set_xticklabels(order, fontsize=14)
-                subplot_id += 1
-                if i == n_rows * n_cols - 1:
-                    break
-            if subplot_id < n_rows * n_cols:
-                for j in range(subplot_id, n_rows * n_cols):
-                    axes[j].set_visible(False)
+            ymax = None if free_ymax else (global_ymax if use_global_ymax else fig_ymax)
             figure_id = roi_rank // (n_rows * n_cols)
-            output_basename = self.output_basename()
             save_path = os.path.join(self.output_dir, '{}_{}.png'.format(output_basename, str(figure_id).zfill(3)))
-            TracerAnalysis.save_fig_maximize(plt.gcf(), save_path)
-            self.write_meta_info(output_basename)
+            self.figure_renderer.submit(TracerAnalysis._draw_scatter_page, save_path,
+                                        df.loc[df['roi_name'].isin(page_rois)], page_rois, data_type,
+                                        n_rows, n_cols, order, hue_order, dict(self.color_map), ymax, tracer_preamble)
+        self.write_meta_info(output_basename)
+
+    @staticmethod
+    def _draw_scatter_page(df, rois, data_type, n_rows, n_cols, order, hue_order, color_map, ymax, tracer_preamble):
+        """ one subplot per roi. y axis is bounded by ymax * 1.1, free if ymax is None """
+        fig, axes = plt.subplots(nrows=n_rows, ncols=n_cols, sharey=False, sharex=False)
+        axes = axes.flatten()
+        for i, roi in enumerate(rois):
+            df_roi = df.loc[df['roi_name'] == roi]
+            axes[i].set_xlim([0, 5])
+            axes[i].set_xticks([1, 4])
+            axes[i].axvline(x=3, ymin=0, ymax=1, color='black', linestyle='dashed')
+            # for seaborn 0.9.1, if y is passed as series instead of numpy array, the legend is incorrectly generated
+            sns.stripplot(x='hemisphere', y=df_roi[data_type].values, hue='injection_site',
+                          data=df_roi, jitter=False, ax=axes[i], palette=color_map, dodge=True, size=7.5,
+                          order=order, hue_order=hue_order)
+            if ymax is not None:
+                axes[i].set_ylim([0, ymax * 1.1])
+            axes[i].set_ylabel('{} {}'.format(tracer_preamble, roi), fontsize=14)
+            axes[i].set_xlabel('')
+            axes[i].set_xticklabels(order, fontsize=14)
+        for j in range(len(rois), n_rows * n_cols):
+            axes[j].set_visible(False)
+        return fig
 
     def plot_fraction_by_ara_level(self):
         """
         plot connectivity fraction distribution by ara level. this function does
         not use selected data. it does combine TracerConnectivity data with
         identical series insensitive case_tracer
-        :param injection_color_codes:
         """
-        n_injection_sites = len(self.unique_injection_sites())
-        n_figure_rows = int(math.ceil(n_injection_sites / 2))
-        n_figure_cols = 2
-        fig, axes = plt.subplots(nrows=n_figure_rows, ncols=n_figure_cols, sharex=True, sharey=True)
-        if n_figure_rows * n_figure_cols == 1:
-            axes = [axes]
-        else:
-            axes = axes.flatten()
-
         # set cmap to case_tracer_series_insensitive
         self.set_cmap('case_tracer_series_insensitive')
 
         # case_tracer: (injection_site, injection_site_level)
         case_tracer_injection_sites = {}
-        # injection_site: subplot_id
-        injection_subplot_ids = dict(zip(self.unique_injection_sites(),
-                                         range(n_injection_sites)))
-        legend_elements = defaultdict(list)
-
         df_ara_levels = []
         for tracer_connectivity in self.tracer_connectivities:
             case_tracer = tracer_connectivity.case_tracer(series_insensitive=True)
@@ -602,11 +733,34 @@ class TracerAnalysis:
         if self.ara_level_subset is not None:
             df_ara_levels = df_ara_levels.loc[df_ara_levels.ara_level.isin(self.ara_level_subset)]
 
+        output_basename = self.output_basename()
+        save_path = os.path.join(self.output_dir, '{}.png'.format(output_basename))
+        self.figure_renderer.submit(TracerAnalysis._draw_fraction_by_ara_level, save_path, df_ara_levels,
+                                    list(self.unique_injection_sites()), self.case_tracers(series_insensitive=True),
+                                    case_tracer_injection_sites, dict(self.color_map))
+        self.write_meta_info(output_basename)
+
+    @staticmethod
+    def _draw_fraction_by_ara_level(df_ara_levels, injection_sites, case_tracers, case_tracer_injection_sites,
+                                    color_map):
+        n_injection_sites = len(injection_sites)
+        n_figure_rows = int(math.ceil(n_injection_sites / 2))
+        n_figure_cols = 2
+        fig, axes = plt.subplots(nrows=n_figure_rows, ncols=n_figure_cols, sharex=True, sharey=True)
+        if n_figure_rows * n_figure_cols == 1:
+            axes = [axes]
+        else:
+            axes = axes.flatten()
+
+        # injection_site: subplot_id
+        injection_subplot_ids = dict(zip(injection_sites, range(n_injection_sites)))
+        legend_elements = defaultdict(list)
+
         fraction_max = 0
-        for case_tracer in self.case_tracers(series_insensitive=True):
+        for case_tracer in case_tracers:
             injection_site = case_tracer_injection_sites[case_tracer][0]
             injection_site_level = case_tracer_injection_sites[case_tracer][1]
-            color = self.color_map[case_tracer]
+            color = color_map[case_tracer]
             ax_id = injection_subplot_ids[injection_site]
             df_case_tracer = df_ara_levels.loc[df_ara_levels['case_tracer'] == case_tracer]
             df_case_tracer = df_case_tracer.assign(fraction=lambda df: df.overlap / df.overlap.sum())
@@ -625,10 +779,7 @@ class TracerAnalysis:
             axes[ax_id].legend(handles=legend_elements[ax_id])
         for ax_id in range(n_injection_sites, n_figure_rows * n_figure_cols):
             axes[ax_id].set_visible(False)
-        output_basename = self.output_basename()
-        save_path = os.path.join(self.output_dir, '{}.png'.format(output_basename))
-        TracerAnalysis.save_fig_maximize(plt.gcf(), save_path)
-        self.write_meta_info(output_basename)
+        return fig
 
     def plot_ara_levels(self, group_by='injection_site'):
         if group_by not in { 'injection_site', 'case_tracer', 'case_tracer_series_insensitive' }:
@@ -651,12 +802,24 @@ class TracerAnalysis:
                 'hue': tracer_connectivity.injection_site,
             }))
         df_levels = pd.concat(df_levels)
-        sns.stripplot(x='ara_level', y=group_by_column, hue='hue', data=df_levels)
         output_basename = self.output_basename()
         save_path = os.path.join(self.output_dir, '{}.png'.format(output_basename))
-        TracerAnalysis.save_fig_maximize(plt.gcf(), save_path)
+        self.figure_renderer.submit(TracerAnalysis._draw_ara_levels, save_path, df_levels, group_by_column)
         self.write_meta_info(output_basename)
 
+    @staticmethod
+    def _draw_ara_levels(df_levels, group_by_column):
+        fig, ax = plt.subplots()
+        sns.stripplot(x='ara_level', y=group_by_column, hue='hue', data=df_levels, ax=ax)
+        return fig
+
+    def wait_figures(self):
+        """
+        block until all figures requested so far are written
+        :return: paths of the figures written
+        """
+        return self.figure_renderer.wait()
+
     def write_data_long(self, data_type):
         if len(self.selected_data) == 0:
             raise ValueError('no data selected')
@@ -687,6 +850,22 @@ class TracerAnalysis:
             os.makedirs(self.output_dir)
         assert os.path.isdir(self.output_dir)
 
+    def set_figure_renderer(self, n_workers=None, figure_renderer=None):
+        """
+        :param n_workers: None or 1 renders figures in process, otherwise in a
+                          pool of n_workers headless processes
+        :param figure_renderer: FigureRenderer to use instead of a new one, e.g.
+                                to share one pool between analyses. it is not
+                                closed by the analysis, its owner closes it
+        """
+        if self._owns_figure_renderer:
+            self.figure_renderer.close()
+        if figure_renderer is None:
+            self.figure_renderer = FigureRenderer(n_workers=n_workers)
+        else:
+            self.figure_renderer = figure_renderer
+        self._owns_figure_renderer = figure_renderer is None
+
     def set_cmap(self, color_map_by):
         """
         sets the colors to be used in plots. if number of colors required is
@@ -694,6 +873,7 @@ class TracerAnalysis:
         :return:
         """
         assert color_map_by in { 'injection_site', 'case_tracer', 'case_tracer_series_insensitive' }
+        self.color_map_by = color_map_by
         if color_map_by == 'injection_site':
             id_vars = self.unique_injection_sites()
         elif color_map_by == 'case_tracer':
@@ -718,6 +898,7 @@ class TracerAnalysis:
         for tracer_connectivity in self.tracer_connectivities:
             tracer_connectivity.set_ara_level_subset(ara_level_subset=self.ara_level_subset)
         self.build_data()
+        self.selected_cube = None
         self.selected_data.clear()
 
     def set_roi_exclusion_subset(self, roi_exclusion_subset):
@@ -730,7 +911,6 @@ class TracerAnalysis:
 
     def set_selection_parameters(self, hemispheres='i+c', roi_names=None, roi_group_names=None,
                                  roi_aggregate_rule=None, case_aggregate_rule=None):
-        SelectionParameters = namedtuple('SelectionParameters', ['hemispheres', 'roi_names', 'roi_group_names', 'roi_aggregate_rule', 'case_aggregate_rule'])
         if hemispheres not in {'i+c', 'i', 'c'}:
             raise ValueError('hemispheres: {} not understood'.format(hemispheres))
         if isinstance(roi_names, str):
@@ -810,11 +990,13 @@ class TracerAnalysis:
     def time_stamp():
         return time.strftime("%y%m%d-%H_%M_%S", time.localtime())
 
-    # return output basename and its associated time stamp
+    # return output basename: analysis name, calling method, time stamp of the
+    # instance's construction and output count. names are decided when a plot
+    # is requested, independent of when its figure finishes rendering
     def output_basename(self):
         caller_name = TracerAnalysis._get_caller_name()
-        time_stamp = TracerAnalysis.time_stamp()
-        return '_'.join([self.analysis_name, caller_name, time_stamp])
+        self._output_count += 1
+        return '_'.join([self.analysis_name, caller_name, self._time_stamp, str(self._output_count).zfill(4)])
 
     def write_meta_info(self, basename):
         meta_info_path = os.path.join(self.output_dir, '{}_meta_info.txt'.format(basename))
@@ -2,8 +2,12 @@ from __future__ import print_function, division
 import os
 import re
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
-from level_connectivity import LevelConnectivity
+from scipy import sparse
+from level_connectivity import LevelConnectivity, GridLevelConnectivity
+from level_connectivity_cache import LevelConnectivityCache
 from custom_atlas_config import CustomAtlasConfig
 
 
@@ -15,6 +19,11 @@ class TracerConnectivity:
     dataframe:
        tracer_connectivity. index: hemisphere roi names
          [roi_index, hemisphere, overlap, area]
+    level tensor:
+       level_tensor. dense float array of shape (ara level, roi, hemisphere, 2). axes are ordered as self.ara_levels_all,
+       self.roi_indices (gray matter rgb indices of the atlas, ascending), TracerConnectivity.HEMISPHERES and
+       TracerConnectivity.LEVEL_TENSOR_VALUES. self.roi_names holds the roi name of each entry in self.roi_indices. tracer_connectivity is the sum of level_tensor over the ara levels
+       within ara_level_subset
     overlap_dir: directory where csv files are located
     csv_names: list of csv files to include under overlap_dir. for each instance, all csv files are expected to have
     the same meta info. see self.get_meta_info
@@ -22,12 +31,22 @@ class TracerConnectivity:
     keys are accepted: injection site roi string, (case_id, channel) tuple. roi string take precedence, channel is expected
     to be str type
     injection site parsed from csv file is a key of the dict, replace with dict value of the key
+    cache_dir: if given, parsed csv files are cached under cache_dir (see LevelConnectivityCache). only csv files
+    without an up to date cache entry are parsed
+    level_data: dict csv_name: (meta_info, df) of csv files already parsed elsewhere, e.g. by the worker pool of
+    TracerConnectivityBuilder. these csv files are neither parsed nor loaded from the cache
     """
 
-    def __init__(self, overlap_dir, csv_names=None, injection_site=None, injection_site_level=None):
+    # hemisphere axis and last axis of level_tensor
+    HEMISPHERES = ['l', 'r']
+    LEVEL_TENSOR_VALUES = ['overlap', 'area']
+
+    def __init__(self, overlap_dir, csv_names=None, injection_site=None, injection_site_level=None, cache_dir=None,
+                 level_data=None):
         if not os.path.isdir(overlap_dir):
             raise ValueError('{} does not exist'.format(overlap_dir))
         self.overlap_dir = overlap_dir
+        self.cache = LevelConnectivityCache(cache_dir) if cache_dir is not None else None
 
         if csv_names is None:
             self.csv_names = [name for name in os.listdir(self.overlap_dir) if name.endswith('.csv')]
@@ -36,7 +55,7 @@ class TracerConnectivity:
 
         # ara level int: LevelConnectivity object
         self.level_connectivities = {}
-        self.construct_level_connectivities()
+        self.construct_level_connectivities(level_data=level_data)
         if len(self.level_connectivities) == 0:
             raise ValueError('no LevelConnectivity objects constructed from {}'.format(overlap_dir))
 
@@ -59,6 +78,9 @@ class TracerConnectivity:
         # injection site level is None (unknown) by default
         self.injection_site_level = injection_site_level
 
+        self.ara_levels_all = self.roi_indices = self.roi_names = self.level_tensor = self._roi_names_hemi = None
+        self.build_level_tensor()
+
         # contains all roi in the custom atlas, even if the particular roi does
         # not appear in the levels present for the channel
         self.tracer_connectivity = None
@@ -76,11 +98,25 @@ class TracerConnectivity:
             self.ara_level_subset = set([ara_level for ara_level in self.level_connectivities])
         self.build_tracer_connectivity()
 
-    def construct_level_connectivities(self):
+    # csv files with an up to date cache entry are loaded from the cache, the rest are parsed and added to the cache
+    def construct_level_connectivities(self, level_data=None):
+        loaded = dict(level_data) if level_data is not None else {}
+        if self.cache is not None:
+            loaded.update(self.cache.load(self.overlap_dir,
+                                          [csv_name for csv_name in self.csv_names if csv_name not in loaded]))
+        parsed = {}
         for csv_name in self.csv_names:
-            level_connectivity = LevelConnectivity(os.path.join(self.overlap_dir, csv_name))
+            csv_path = os.path.join(self.overlap_dir, csv_name)
+            if csv_name in loaded:
+                meta_info, df = loaded[csv_name]
+                level_connectivity = LevelConnectivity(csv_path, meta_info=meta_info, df=df)
+            else:
+                level_connectivity = LevelConnectivity(csv_path)
+                parsed[csv_name] = (level_connectivity.csv_parser.meta_info(), level_connectivity.df)
             ara_level = level_connectivity.csv_parser.ara_level()
             self.level_connectivities[ara_level] = level_connectivity
+        if self.cache is not None and len(parsed) > 0:
+            self.cache.store(self.overlap_dir, parsed)
 
     def get_meta_info(self):
         ara_levels = [k for k in self.level_connectivities.keys()]
@@ -110,35 +146,54 @@ class TracerConnectivity:
                 raise AssertionError('meta data info conflict in case {} channel {} at ara {} and ara {}'
                                      .format(self.case_name, self.channel_number, ara_levels[0], ara_level))
 
+    # accumulate overlap and area of every level connectivity into self.level_tensor
+    def build_level_tensor(self):
+        self.ara_levels_all = np.array(sorted(self.level_connectivities.keys()))
+        lookup = self.custom_atlas_config.lookup
+        # roi ids ascend with rgb index, so gray matter rgb indices are ascending
+        self.roi_indices = lookup.rgb_indices[lookup.gray_matter]
+        self.level_tensor = np.zeros((len(self.ara_levels_all), len(self.roi_indices),
+                                      len(TracerConnectivity.HEMISPHERES), len(TracerConnectivity.LEVEL_TENSOR_VALUES)))
+        for level_id, ara_level in enumerate(self.ara_levels_all):
+            connectivity = self.level_connectivities[ara_level].connectivity()
+            roi_ids = np.searchsorted(self.roi_indices, connectivity['rgb_index'].values)
+            hemispheres = connectivity['hemisphere'].values
+            hemisphere_ids = np.searchsorted(TracerConnectivity.HEMISPHERES, hemispheres)
+            if not np.isin(hemispheres, TracerConnectivity.HEMISPHERES).all():
+                raise ValueError('unknown hemisphere encountered in case {} channel {} ara level {}'
+                                 .format(self.case_name, self.channel_number, ara_level))
+            # rows with identical roi and hemisphere are summed
+            np.add.at(self.level_tensor[level_id], (roi_ids, hemisphere_ids),
+                      connectivity[TracerConnectivity.LEVEL_TENSOR_VALUES].values)
+        # hemisphere roi names, roi major and hemisphere minor. l is contralateral, r is ipsilateral
+        self.roi_names = lookup.roi_names[lookup.gray_matter]
+        hemisphere_suffixes = np.array(['_c', '_i'], dtype=object)
+        self._roi_names_hemi = pd.Index(np.repeat(self.roi_names, len(hemisphere_suffixes)) +
+                                        np.tile(hemisphere_suffixes, len(self.roi_names)), name='roi_name')
+
+    # boolean mask over the ara level axis of self.level_tensor
+    def ara_level_mask(self, ara_level_subset=None):
+        if ara_level_subset is None:
+            ara_level_subset = self.ara_level_subset
+        return np.isin(self.ara_levels_all, list(ara_level_subset))
+
+    # sum of self.level_tensor over ara levels in the subset, shape (roi, hemisphere, 2).
+    # defaults to self.ara_level_subset. does not modify the instance
+    def reduce_level_tensor(self, ara_level_subset=None):
+        return self.level_tensor[self.ara_level_mask(ara_level_subset)].sum(axis=0)
+
     # for ara levels not in the subset, during tracer connectivity construction,
-    # replace overlap and area values from these levels with 0
+    # treat overlap and area values from these levels as 0
     def build_tracer_connectivity(self):
-        # level connectivity data
-        connectivity = pd.concat([level_connectivity.connectivity()
-                                  .assign(overlap=lambda df: df.overlap * int(ara_level in self.ara_level_subset),
-                                          area=lambda df: df.area * int(ara_level in self.ara_level_subset))
-                                  for ara_level, level_connectivity in self.level_connectivities.items()])
-        # group by roi_index and hemisphere, sum overlap and area
-        connectivity = connectivity.groupby(['rgb_index', 'hemisphere']).sum().reset_index()
-        # roi indices in atlas but did not appear in csv files
-        remainder_indices = list(set(self.custom_atlas_config.roi_info.gray_matter_indices) -
-                                 set(connectivity['rgb_index']))
-        remainder = pd.DataFrame({
-            'rgb_index': remainder_indices * 2,
-            'hemisphere': ['l'] * len(remainder_indices) + ['r'] * len(remainder_indices),
-            'overlap': 0,
-            'area': 0
-        })
-        # sort rgb_index and hemisphere ascending
-        self.tracer_connectivity = pd.concat([connectivity, remainder])
-        self.tracer_connectivity = self.tracer_connectivity.sort_values(by=['rgb_index', 'hemisphere'])
-        # roi_name column
-        roi_name = self.tracer_connectivity['rgb_index'].apply(self.custom_atlas_config.rgb_codec.index_to_region)
-        roi_name_hemi = roi_name.str.cat(others=self.tracer_connectivity['hemisphere']
-                                                    .apply(lambda x: 'c' if x == 'l' else 'i'),
-                                         sep='_')
-        self.tracer_connectivity = self.tracer_connectivity.set_index(roi_name_hemi)
-        self.tracer_connectivity.index.name = 'roi_name'
+        connectivity = self.reduce_level_tensor()
+        n_hemispheres = len(TracerConnectivity.HEMISPHERES)
+        # sorted by rgb_index and hemisphere ascending
+        self.tracer_connectivity = pd.DataFrame({
+            'rgb_index': np.repeat(self.roi_indices, n_hemispheres),
+            'hemisphere': np.tile(np.array(TracerConnectivity.HEMISPHERES, dtype=object), len(self.roi_indices)),
+            'overlap': connectivity[:, :, 0].ravel(),
+            'area': connectivity[:, :, 1].ravel()
+        }, index=self._roi_names_hemi)
 
     # columns rgb_index, hemisphere, overlap, area, ara_level
     def tracer_connectivity_by_ara_levels(self):
@@ -165,34 +220,141 @@ class TracerConnectivity:
         return self.tracer_connectivity.nlargest(n, 'overlap').index.values
 
 
+class GridTracerConnectivity(TracerConnectivity):
+    """
+    GridTracerConnectivity class:
+    grid mode counterpart of TracerConnectivity. connectivity of all sections
+    from a single tracer in a single case, per grid cell instead of per roi
+    dataframe:
+       tracer_connectivity. index: cell_id (see GridLevelConnectivity)
+         [row, col, overlap, area]
+       only cells with non zero area in at least one ara level are included
+    sparse level store:
+       level_overlap, level_area. scipy.sparse csc matrices of shape (cell, ara level). axes are ordered as
+       self.cell_ids (ascending) and self.ara_levels_all. tracer_connectivity is the sum of the store over the ara
+       levels within ara_level_subset
+    csv_names: defaults to the grid csv files under overlap_dir. grid csv files are not cached
+    """
+    def __init__(self, overlap_dir, csv_names=None, injection_site=None, injection_site_level=None):
+        if csv_names is None and os.path.isdir(overlap_dir):
+            csv_names = [name for name in os.listdir(overlap_dir) if name.endswith('.csv') and 'grid' in name]
+        self.cell_ids = self.level_overlap = self.level_area = None
+        super(GridTracerConnectivity, self).__init__(overlap_dir, csv_names=csv_names, injection_site=injection_site,
+                                                     injection_site_level=injection_site_level)
+
+    def construct_level_connectivities(self, level_data=None):
+        for csv_name in self.csv_names:
+            level_connectivity = GridLevelConnectivity(os.path.join(self.overlap_dir, csv_name))
+            self.level_connectivities[level_connectivity.csv_parser.ara_level()] = level_connectivity
+
+    # accumulate overlap and area of every level connectivity into the sparse level store
+    def build_level_tensor(self):
+        self.ara_levels_all = np.array(sorted(self.level_connectivities.keys()))
+        level_connectivities = [self.level_connectivities[ara_level] for ara_level in self.ara_levels_all]
+        cell_ids = np.concatenate([level_connectivity.cell_ids for level_connectivity in level_connectivities])
+        self.cell_ids, cell_positions = np.unique(cell_ids, return_inverse=True)
+        level_ids = np.repeat(np.arange(len(level_connectivities)),
+                              [len(level_connectivity.cell_ids) for level_connectivity in level_connectivities])
+        shape = (len(self.cell_ids), len(self.ara_levels_all))
+        self.level_overlap = sparse.csc_matrix((np.concatenate([level_connectivity.overlap
+                                                                for level_connectivity in level_connectivities]),
+                                                (cell_positions, level_ids)), shape=shape)
+        self.level_area = sparse.csc_matrix((np.concatenate([level_connectivity.area
+                                                             for level_connectivity in level_connectivities]),
+                                             (cell_positions, level_ids)), shape=shape)
+
+    # sum of the sparse level store over ara levels in the subset, shape (cell, 2).
+    # defaults to self.ara_level_subset. does not modify the instance
+    def reduce_level_tensor(self, ara_level_subset=None):
+        mask = self.ara_level_mask(ara_level_subset).astype(np.float64)
+        return np.stack([self.level_overlap.dot(mask), self.level_area.dot(mask)], axis=-1)
+
+    def build_tracer_connectivity(self):
+        connectivity = self.reduce_level_tensor()
+        self.tracer_connectivity = pd.DataFrame({
+            'row': self.cell_ids // GridLevelConnectivity.CELL_ROW_STRIDE,
+            'col': self.cell_ids % GridLevelConnectivity.CELL_ROW_STRIDE,
+            'overlap': connectivity[:, 0],
+            'area': connectivity[:, 1]
+        }, index=pd.Index(self.cell_ids, name='cell_id'))
+
+
+# parse a single csv file. module level so that it can be sent to worker processes
+def _parse_level_data(csv_path):
+    level_connectivity = LevelConnectivity(csv_path)
+    return level_connectivity.csv_parser.meta_info(), level_connectivity.df
+
+
 # take an overlap directory with potentially a mix of cases and series,
 # split them into distinct groups identified by case and series, and return
 # one TracerConnectivity object for each
+# n_workers: if greater than 1, csv files are parsed by a pool of n_workers
+# processes. TracerConnectivity objects are still assembled in this process,
+# in the same order as without the pool
 class TracerConnectivityBuilder:
-    def __init__(self, overlap_dirs, injection_site_roi_mapper=None):
+    def __init__(self, overlap_dirs, injection_site_roi_mapper=None, cache_dir=None, n_workers=None, csv_filter=None):
         self.overlap_dirs = overlap_dirs
         self.injection_site_roi_mapper = injection_site_roi_mapper
+        self.cache_dir = cache_dir
+        self.n_workers = n_workers
+        # callable (overlap_dir, csv_name) -> bool. csv files it rejects are neither parsed nor loaded, see CorpusIndex
+        self.csv_filter = csv_filter
         self.tracer_connectivities = []
         self.build_tracer_connectivities()
 
     def build_tracer_connectivities(self):
+        csv_groups = []
         for overlap_dir in self.overlap_dirs:
             if not os.path.isdir(overlap_dir):
                 raise ValueError('{} is not a directory'.format(overlap_dir))
-            self._build_tracer_connectivities_in_dir(overlap_dir)
+            csv_groups.extend(self._csv_groups_in_dir(overlap_dir, csv_filter=self.csv_filter))
+        if self.n_workers is None or self.n_workers <= 1:
+            groups_level_data = [None] * len(csv_groups)
+        else:
+            groups_level_data = self._parse_in_pool(csv_groups)
+        for (overlap_dir, csv_names), level_data in zip(csv_groups, groups_level_data):
+            self.tracer_connectivities.append(TracerConnectivity(overlap_dir, csv_names, injection_site=self.injection_site_roi_mapper,
+                                                                 cache_dir=self.cache_dir, level_data=level_data))
 
-    def _build_tracer_connectivities_in_dir(self, overlap_dir):
+    # returns a list of (overlap_dir, csv_names), one for each case and series in the directory
+    @staticmethod
+    def _csv_groups_in_dir(overlap_dir, csv_filter=None):
         # do not add files repetitively
         overlap_files = defaultdict(set)
         for name in os.listdir(overlap_dir):
             if not name.endswith('.csv'):
                 continue
+            if csv_filter is not None and not csv_filter(overlap_dir, name):
+                continue
             # series sensitive case format matching
             m = re.match(re.compile('[a-zA-Z]{2}[0-9]{6}-[0-9]{2}[A-Z]'), name)
             if not m:
                 continue
             overlap_files[m.group()].add(name)
-        for csv_names in overlap_files.values():
-            self.tracer_connectivities.append(TracerConnectivity(overlap_dir, csv_names, injection_site=self.injection_site_roi_mapper))
-
+        return [(overlap_dir, csv_names) for csv_names in overlap_files.values()]
 
+    # parse csv files of all groups in worker processes. csv files with an up
+    # to date cache entry are loaded in this process instead, and newly parsed
+    # csv files are written to the cache from this process only
+    def _parse_in_pool(self, csv_groups):
+        cache = LevelConnectivityCache(self.cache_dir) if self.cache_dir is not None else None
+        groups_level_data = []
+        stale = []
+        for group_id, (overlap_dir, csv_names) in enumerate(csv_groups):
+            level_data = cache.load(overlap_dir, csv_names) if cache is not None else {}
+            stale.extend([(group_id, csv_name) for csv_name in sorted(csv_names) if csv_name not in level_data])
+            groups_level_data.append(level_data)
+        if len(stale) == 0:
+            return groups_level_data
+        csv_paths = [os.path.join(csv_groups[group_id][0], csv_name) for group_id, csv_name in stale]
+        chunksize = max(1, len(csv_paths) // (4 * self.n_workers))
+        with ProcessPoolExecutor(max_workers=self.n_workers) as executor:
+            results = list(executor.map(_parse_level_data, csv_paths, chunksize=chunksize))
+        parsed = defaultdict(dict)
+        for (group_id, csv_name), result in zip(stale, results):
+            groups_level_data[group_id][csv_name] = result
+            parsed[group_id][csv_name] = result
+        if cache is not None:
+            for group_id, level_data in parsed.items():
+                cache.store(csv_groups[group_id][0], level_data)
+        return groups_level_data
@@ -551,10 +551,12 @@ class TranslateColors:
         :return: index_atlas
         """
         assert len(rgb_atlas.shape) == 3, "rgb_atlas must have r, g, b channels"
-        r_val = rgb_atlas[:, :, 2].astype(np.int32) * 256 * 256
-        g_val = rgb_atlas[:, :, 1].astype(np.int32) * 256
-        b_val = rgb_atlas[:, :, 0]
-        index_atlas = r_val + g_val + b_val
+        # channels are packed into the output in place, (r << 16) | (g << 8) | b
+        index_atlas = rgb_atlas[:, :, 2].astype(np.int32)
+        np.left_shift(index_atlas, 8, out=index_atlas)
+        np.bitwise_or(index_atlas, rgb_atlas[:, :, 1], out=index_atlas)
+        np.left_shift(index_atlas, 8, out=index_atlas)
+        np.bitwise_or(index_atlas, rgb_atlas[:, :, 0], out=index_atlas)
         return index_atlas
 
     @staticmethod